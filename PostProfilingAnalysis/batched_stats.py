@@ -0,0 +1,152 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+from scipy.stats import anderson_ksamp
+
+# Two-sample Anderson-Darling tests (scipy.stats.anderson_ksamp with k = 2 and
+# midrank) for many (norm, bug) array pairs at once. The pairs are concatenated into
+# one array indexed by pair and sample, so the rank statistics of all pairs come out
+# of a single sort; only the normalization and the p-value interpolation are done per
+# pair, with the same scalar arithmetic as scipy.
+
+ADResult = namedtuple('ADResult', ['statistic', 'pvalue'])
+
+# Table 2 of Scholz and Stephens 1987, as used by scipy for k - 1 = 1 degree of freedom
+SIGNIFICANCE = np.array([0.25, 0.1, 0.05, 0.025, 0.01, 0.005, 0.001])
+CRITICAL = np.array([0.675, 1.281, 1.645, 1.96, 2.326, 2.573, 3.085]) + \
+        np.array([-0.245, 0.25, 0.678, 1.149, 1.822, 2.364, 3.615]) / math.sqrt(1) + \
+        np.array([-0.105, -0.305, -0.362, -0.391, -0.396, -0.345, -0.154]) / 1
+#interpolation of the log significance over the critical values
+PVALUE_FIT = np.polyfit(CRITICAL, np.log(SIGNIFICANCE), 2)
+CRITICAL_MIN = float(CRITICAL.min())
+CRITICAL_MAX = float(CRITICAL.max())
+
+#scipy divides by (N - 1)(N - 2)(N - 3); smaller pairs go through scipy itself
+MIN_OBSERVATIONS = 4
+
+harmonic_sums = {}
+
+def harmonic_terms(N):
+    """h and g of the variance of the statistic, computed as in scipy and kept per N
+    """
+    if N not in harmonic_sums:
+        hs_cs = (1. / np.arange(N - 1, 1, -1)).cumsum()
+        harmonic_sums[N] = (hs_cs[-1] + 1, (hs_cs / np.arange(2, N)).sum())
+    return harmonic_sums[N]
+
+def midrank_statistics(pairs):
+    """A2akN (equation 7 of Scholz and Stephens) of every pair, from one sort of all
+    observations by (pair, value). Returns the statistics, the sample sizes and the
+    number of distinct observations of each pair.
+    """
+    npairs = len(pairs)
+    sizes = np.array([[norm.size, bug.size] for norm, bug in pairs], dtype=np.int64).reshape(npairs, 2)
+    arrays = [array for pair in pairs for array in pair]
+    values = np.concatenate(arrays)
+    pair_ids = np.repeat(np.arange(npairs), sizes.sum(axis=1))
+    sample_ids = np.repeat(np.tile([0, 1], npairs), sizes.ravel())
+    order = np.lexsort((values, pair_ids))
+    values = values[order]
+    pair_ids = pair_ids[order]
+    sample_ids = sample_ids[order]
+
+    #one group per distinct value of a pair, the Zstar of scipy
+    starts = np.ones(values.size, dtype=bool)
+    starts[1:] = (values[1:] != values[:-1]) | (pair_ids[1:] != pair_ids[:-1])
+    group_starts = np.flatnonzero(starts)
+    group_pairs = pair_ids[group_starts]
+    counts = np.diff(np.append(group_starts, values.size))
+    bug_counts = np.add.reduceat(sample_ids, group_starts)
+    sample_counts = [counts - bug_counts, bug_counts]
+
+    N = sizes.sum(axis=1)
+    pair_starts = np.concatenate(([0], np.cumsum(N)[:-1]))
+    distinct = np.bincount(group_pairs, minlength=npairs)
+    group_N = N[group_pairs]
+    lj = counts.astype(float)
+    Bj = (group_starts - pair_starts[group_pairs]) + lj / 2.
+    first_group = np.concatenate(([0], np.cumsum(distinct)[:-1]))
+
+    inners = []
+    for i in range(2):
+        cumulative = np.cumsum(sample_counts[i])
+        #observations of sample i up to and including the group, within the pair
+        below = np.concatenate(([0], cumulative))[first_group]
+        Mij = (cumulative - below[group_pairs]).astype(float)
+        Mij -= sample_counts[i] / 2.
+        n_i = sizes[group_pairs, i]
+        inners.append(lj / group_N * (group_N*Mij - Bj*n_i)**2 / (Bj*(group_N - Bj) - group_N*lj/4.))
+
+    #sum each pair's slice with np.sum, whose pairwise summation np.add.reduceat does not share
+    A2akN = np.zeros(npairs)
+    last_group = first_group + distinct
+    for j in range(npairs):
+        statistic = 0.
+        for i in range(2):
+            statistic += inners[i][first_group[j]:last_group[j]].sum() / sizes[j, i]
+        statistic *= (N[j] - 1.) / N[j]
+        A2akN[j] = statistic
+    return A2akN, sizes, distinct
+
+def standardize(A2akN, n, N, k=2):
+    """the normalized statistic A2 and its p-value, following scipy.stats.anderson_ksamp
+    for the two sample sizes n
+    """
+    H = 1. / n[0] + 1. / n[1]
+    h, g = harmonic_terms(N)
+    a = (4*g - 6) * (k - 1) + (10 - 6*g)*H
+    b = (2*g - 4)*k**2 + 8*h*k + (2*g - 14*h - 4)*H - 8*h + 4*g - 6
+    c = (6*h + 2*g - 2)*k**2 + (4*h - 4*g + 6)*k + (2*h - 6)*H + 4*h
+    d = (2*h + 6)*k**2 - 4*h*k
+    sigmasq = (a*N**3 + b*N**2 + c*N + d) / ((N - 1.) * (N - 2.) * (N - 3.))
+    m = k - 1
+    A2 = (A2akN - m) / math.sqrt(sigmasq)
+    if A2 < CRITICAL_MIN:
+        p = SIGNIFICANCE.max()
+    elif A2 > CRITICAL_MAX:
+        p = SIGNIFICANCE.min()
+    else:
+        #Horner's rule in the order of np.polyval
+        y = 0.
+        for coefficient in PVALUE_FIT.tolist():
+            y = y * A2 + coefficient
+        p = math.exp(y)
+    return A2, p
+
+def per_call(norm, bug):
+    """the scipy path, None where scipy rejects the input
+    """
+    try:
+        stat, critical_values, pvalue = anderson_ksamp([np.asarray(norm), np.asarray(bug)])
+    except Exception:
+        return None
+    return ADResult(stat, pvalue)
+
+def anderson_2samp_batch(pairs):
+    """ADResult of every (norm, bug) pair, None where scipy raises (a single
+    distinct observation or an empty sample). Pairs are batched per common dtype,
+    so values are compared after the same type promotion as np.hstack in scipy;
+    pairs with fewer than MIN_OBSERVATIONS observations are passed to scipy.
+    """
+    results = [None] * len(pairs)
+    batches = {}
+    for index, (norm, bug) in enumerate(pairs):
+        norm = np.asarray(norm)
+        bug = np.asarray(bug)
+        if norm.size == 0 or bug.size == 0:
+            continue
+        if norm.size + bug.size < MIN_OBSERVATIONS:
+            results[index] = per_call(norm, bug)
+            continue
+        dtype = np.result_type(norm, bug)
+        batches.setdefault(dtype, []).append((index, norm.astype(dtype, copy=False), bug.astype(dtype, copy=False)))
+
+    for batch in batches.values():
+        A2akN, sizes, distinct = midrank_statistics([(norm, bug) for _, norm, bug in batch])
+        for j, (index, norm, bug) in enumerate(batch):
+            if distinct[j] < 2:
+                continue
+            n = sizes[j].tolist()
+            results[index] = ADResult(*standardize(A2akN[j], n, n[0] + n[1]))
+    return results
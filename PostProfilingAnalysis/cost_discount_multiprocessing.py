@@ -6,6 +6,8 @@ import argparse
 import re
 import operator
 
+import numpy as np
+
 from gmon_sample_multiprocessing import histEntry, gmonSamples
 
 class CostDiscountCalculator:
@@ -17,6 +19,7 @@ class CostDiscountCalculator:
         self.max_ahead = 3
         #default discount calculated with histograms
         self.rank_counts = defaultdict(lambda:0)
+        self.symbols = {} #symbol -> interned id
         self.cost_discounts = {} 
 
     def set_valid_discount(self, rate):
@@ -27,30 +30,75 @@ class CostDiscountCalculator:
         """
         pass
 
+    def symbol_ids(self, hist):
+        """intern the symbols of a histogram to integer ids
+        """
+        return np.array([self.symbols.setdefault(entry.symbol, len(self.symbols)) for entry in hist], dtype=np.int64)
+
+    def rank_matrix(self, norm_ids):
+        """ranks[o, k, s] is the rank of the o-th entry of symbol s in norm histogram k,
+        -1 if the histogram has fewer entries of s
+        """
+        nsymbols = len(self.symbols)
+        occurrences = []
+        for ids in norm_ids:
+            order = np.argsort(ids, kind='stable')
+            sorted_ids = ids[order]
+            starts = np.ones(ids.size, dtype=bool)
+            starts[1:] = sorted_ids[1:] != sorted_ids[:-1]
+            group_start = np.maximum.accumulate(np.where(starts, np.arange(ids.size), 0))
+            occurrence = np.empty(ids.size, dtype=np.int64)
+            occurrence[order] = np.arange(ids.size) - group_start
+            occurrences.append(occurrence)
+        depth = max([int(occurrence.max()) + 1 for occurrence in occurrences if occurrence.size > 0], default=1)
+        ranks = np.full((depth, len(norm_ids), nsymbols), -1, dtype=np.int64)
+        for k, (ids, occurrence) in enumerate(zip(norm_ids, occurrences)):
+            ranks[occurrence, k, ids] = np.arange(ids.size)
+        return ranks
+
+    def count_ranks(self, bug_hists, norm_hists):
+        """count, per function, the (bug entry, norm histogram) pairs where the norm ranks
+        the function within max_ahead of its rank in the bug histogram.
+        As in the original list probing, a bug entry near the top also matches the
+        bottom norm entries a negative index wraps around to.
+        """
+        bug_ids = [self.symbol_ids(hist) for hist in bug_hists]
+        norm_ids = [self.symbol_ids(hist) for hist in norm_hists]
+        ranks = self.rank_matrix(norm_ids)
+        norm_sizes = np.array([ids.size for ids in norm_ids], dtype=np.int64)[None, :, None]
+        nsymbols = len(self.symbols)
+        counts = np.zeros(nsymbols, dtype=np.int64)
+        #position of the first match of a symbol in the (bug, norm, entry) order of the loops
+        width = max([ids.size for ids in bug_ids], default=0) + 1
+        first_match = np.full(nsymbols, np.iinfo(np.int64).max, dtype=np.int64)
+        for b, ids in enumerate(bug_ids):
+            if ids.size == 0:
+                continue
+            index = np.arange(ids.size)
+            norm_ranks = ranks[:, :, ids]
+            near = np.abs(norm_ranks - index) <= self.max_ahead
+            wrapped = norm_ranks - norm_sizes >= index - self.max_ahead
+            matches = ((norm_ranks >= 0) & (near | wrapped)).any(axis=0)
+            counts += np.bincount(ids, weights=matches.sum(axis=0), minlength=nsymbols).astype(np.int64)
+            k, i = np.nonzero(matches)
+            np.minimum.at(first_match, ids[i], (b * len(norm_ids) + k) * width + i)
+
+        names = list(self.symbols)
+        for symbol in np.argsort(first_match, kind='stable')[:np.count_nonzero(counts)].tolist():
+            self.rank_counts[names[symbol]] += int(counts[symbol])
+        return self.rank_counts
+
     def calculate_rank_counts(self, bug_hist, norm_hist):
         """count similar ranks per function in histograms
         """
-        for index in range(len(bug_hist)):
-            func = bug_hist[index].symbol
-            lookahead = self.max_ahead
-            while lookahead >= -self.max_ahead:
-                try:
-                    if norm_hist[index - lookahead].symbol == func:
-                        self.rank_counts[func] = self.rank_counts[func] + 1
-                        break
-                except:
-                    pass
-                lookahead = lookahead - 1
-        return self.rank_counts
+        return self.count_ranks([bug_hist], [norm_hist])
 
     def aggregate_discount(self):
         """Aggragate discounts based on histograms
         """
-        for bugsample in self.bug_samples.get_samples():
-            for normsample in self.norm_samples.get_samples():
-                bug_hist = bugsample.entries
-                norm_hist = normsample.entries
-                self.calculate_rank_counts(bug_hist, norm_hist)
+        bug_hists = [bugsample.entries for bugsample in self.bug_samples.get_samples()]
+        norm_hists = [normsample.entries for normsample in self.norm_samples.get_samples()]
+        self.count_ranks(bug_hists, norm_hists)
 
         total = self.bug_samples.size * self.norm_samples.size
         for func, count in self.rank_counts.items():
@@ -0,0 +1,354 @@
+import os
+import sys
+import struct
+from collections import namedtuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+# If pyelftools is not installed, the example can also run from the root or
+# examples/ dir of the source distribution.
+sys.path[0:0] = ['.', '..']
+
+from elftools.elf.elffile import ELFFile
+from elftools.elf.sections import SymbolTableSection
+
+# gmon.out layout written by glibc (gmon/sys/gmon_out.h). The records are
+# written as char arrays, so there is no padding between the fields.
+GMON_MAGIC = b'gmon'
+GMON_TAG_TIME_HIST = 0
+GMON_TAG_CG_ARC = 1
+GMON_TAG_BB_COUNT = 2
+GmonHdr = namedtuple('GmonHdr', ['cookie', 'version', 'spare'])
+GmonHdrFormat = '=4si12s'
+HistHdr = namedtuple('HistHdr', ['lowpc', 'highpc', 'hist_size', 'prof_rate', 'dimen', 'dimen_abbrev'])
+HistHdrFormat = '=QQii15sc'
+ArcDtype = np.dtype([('tag', 'u1'), ('from_pc', '=u8'), ('self_pc', '=u8'), ('count', '=u4')])
+HistCounterDtype = np.dtype('=u2')
+# gprof scales text addresses by sizeof(UNIT) before crediting histogram bins
+UNIT_SIZE = 2
+SHF_EXECINSTR = 0x4
+
+class GmonFile:
+    """Histogram and call graph arc records of one gmon.out file
+    """
+    def __init__(self, datafile):
+        self.infile = datafile
+        self.hists = []
+        self.arcs = np.zeros(0, dtype=ArcDtype)
+        self.unpack_raw()
+
+    def unpack_raw(self):
+        with open(self.infile, 'rb') as f:
+            data = f.read()
+        hdr_size = struct.calcsize(GmonHdrFormat)
+        self.hdr = GmonHdr._make(struct.unpack(GmonHdrFormat, data[0:hdr_size]))
+        if self.hdr.cookie != GMON_MAGIC:
+            raise ValueError(f'{self.infile} is not a gmon.out file')
+
+        hist_hdr_size = struct.calcsize(HistHdrFormat)
+        arcs = []
+        offset = hdr_size
+        while offset < len(data):
+            tag = data[offset]
+            if tag == GMON_TAG_TIME_HIST:
+                offset += 1
+                hist_hdr = HistHdr._make(struct.unpack(HistHdrFormat, data[offset:offset + hist_hdr_size]))
+                offset += hist_hdr_size
+                bins = np.frombuffer(data, dtype=HistCounterDtype, count=hist_hdr.hist_size, offset=offset)
+                offset += hist_hdr.hist_size * HistCounterDtype.itemsize
+                self.hists.append((hist_hdr, bins))
+            elif tag == GMON_TAG_CG_ARC:
+                #glibc writes the arcs back to back, each with its own tag byte
+                records = np.frombuffer(data, dtype=ArcDtype, count=(len(data) - offset) // ArcDtype.itemsize, offset=offset)
+                ends = np.flatnonzero(records['tag'] != GMON_TAG_CG_ARC)
+                count = int(ends[0]) if ends.size > 0 else records.size
+                arcs.append(records[:count])
+                offset += count * ArcDtype.itemsize
+                if count == records.size:
+                    break
+            elif tag == GMON_TAG_BB_COUNT:
+                offset += 1
+                ncounts, = struct.unpack('=i', data[offset:offset + 4])
+                offset += 4 + ncounts * 2 * struct.calcsize('=Q')
+            else:
+                raise ValueError(f'{self.infile}: unknown gmon record tag {tag} at offset {offset}')
+        if len(arcs) > 0:
+            self.arcs = np.concatenate(arcs)
+
+    def prof_rate(self):
+        if len(self.hists) == 0:
+            return 0
+        return self.hists[0][0].prof_rate
+
+def sym_class(name):
+    """mimic gprof core_sym_class: drop compiler generated names such as foo.cold,
+    foo.part.0 or symbols containing '$'; nested subprograms foo.NNN are kept
+    """
+    if not name or '$' in name:
+        return False
+    for part in name.split('.')[1:]:
+        if not part.isdigit():
+            return False
+    return True
+
+class SymbolTable:
+    """Text symbols of a binary sorted by address. The range of a symbol ends at
+    the address of the next symbol, the same way gprof lays out its symtab.
+    """
+    def __init__(self, binfile):
+        self.bin = binfile
+        self.names = []
+        self.addrs = np.zeros(0, dtype=np.uint64)
+        self.ends = np.zeros(0, dtype=np.uint64)
+        self.read_elf()
+
+    def read_elf(self):
+        symbols = {}
+        with open(self.bin, 'rb') as f:
+            elffile = ELFFile(f)
+            sections = [section for section in elffile.iter_sections() if isinstance(section, SymbolTableSection)]
+            #prefer the full symbol table, stripped binaries only have .dynsym
+            symtabs = [section for section in sections if section.name == '.symtab'] or sections
+            text_end = 0
+            for symtab in symtabs:
+                for symbol in symtab.iter_symbols():
+                    shndx = symbol['st_shndx']
+                    if not isinstance(shndx, int):
+                        continue
+                    section = elffile.get_section(shndx)
+                    if not section['sh_flags'] & SHF_EXECINSTR:
+                        continue
+                    if symbol['st_info'].type not in ('STT_FUNC', 'STT_NOTYPE', 'STT_GNU_IFUNC'):
+                        continue
+                    if not sym_class(symbol.name):
+                        continue
+                    text_end = max(text_end, section['sh_addr'] + section['sh_size'])
+                    addr = symbol['st_value']
+                    #gprof keeps one symbol per address, preferring global ones
+                    rank = (symbol['st_info'].bind != 'STB_LOCAL', symbol['st_info'].type == 'STT_FUNC')
+                    if addr not in symbols or rank > symbols[addr][0]:
+                        symbols[addr] = (rank, symbol.name)
+
+        addrs = sorted(symbols)
+        self.names = [symbols[addr][1] for addr in addrs]
+        self.addrs = np.array(addrs, dtype=np.uint64)
+        self.ends = np.append(self.addrs[1:], np.uint64(max(text_end, addrs[-1] + 1) if addrs else 0))
+
+    def lookup(self, addresses):
+        """map addresses to symbol indexes, -1 if the address is outside of the text symbols
+        """
+        addresses = np.asarray(addresses, dtype=np.uint64)
+        index = np.searchsorted(self.addrs, addresses, side='right') - 1
+        valid = index >= 0
+        valid[valid] = addresses[valid] < self.ends[index[valid]]
+        return np.where(valid, index, -1)
+
+    def assign_samples(self, hist_hdr, bins):
+        """credit histogram bins to symbols in clock ticks, following gprof hist_assign_samples;
+        a bin spanning several symbols is split by the overlap of their ranges
+        """
+        ticks = np.zeros(len(self.names), dtype=np.float64)
+        if hist_hdr.hist_size == 0 or len(self.names) == 0:
+            return ticks
+        lowpc = hist_hdr.lowpc // UNIT_SIZE
+        hist_scale = float((hist_hdr.highpc - hist_hdr.lowpc) // UNIT_SIZE) / hist_hdr.hist_size
+        nonzero = np.flatnonzero(bins)
+        counts = bins[nonzero].astype(np.float64)
+        bin_low = lowpc + (hist_scale * nonzero).astype(np.int64)
+        bin_high = lowpc + (hist_scale * (nonzero + 1)).astype(np.int64)
+        sym_low = (self.addrs // UNIT_SIZE).astype(np.int64)
+        sym_high = (self.ends // UNIT_SIZE).astype(np.int64)
+
+        #first symbol that may overlap each bin, then walk forward while bins still span symbols
+        index = np.maximum(np.searchsorted(sym_low, bin_low, side='right') - 1, 0)
+        active = np.ones(nonzero.size, dtype=bool)
+        while active.any():
+            active &= index < len(self.names)
+            active &= bin_high >= sym_low[np.minimum(index, len(self.names) - 1)]
+            if not active.any():
+                break
+            j = index[active]
+            overlap = np.minimum(bin_high[active], sym_high[j]) - np.maximum(bin_low[active], sym_low[j])
+            credit = np.where(overlap > 0, overlap * counts[active] / hist_scale, 0.0)
+            np.add.at(ticks, j, credit)
+            index[active] += 1
+        return ticks
+
+symbol_tables = {}
+
+def load_symbol_table(binfile):
+    """symbol tables are built once per binary and shared by all gmon files of the binary;
+    load them before forking workers so that every worker inherits the table
+    """
+    key = os.path.realpath(binfile)
+    if key not in symbol_tables:
+        symbol_tables[key] = SymbolTable(binfile)
+    return symbol_tables[key]
+
+class CallGraph:
+    """call graph arcs in CSR form over interned symbol ids: the callees of symbol i are
+    callees[offsets[i]:offsets[i + 1]], called counts[offsets[i]:offsets[i + 1]] times.
+    Arcs between the same symbols are merged, recursive calls of a symbol are dropped.
+    """
+    def __init__(self, parent_names, child_names, counts):
+        self.ids = {}
+        parents = np.array([self.ids.setdefault(name, len(self.ids)) for name in parent_names], dtype=np.int64)
+        children = np.array([self.ids.setdefault(name, len(self.ids)) for name in child_names], dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+        self.names = list(self.ids)
+        nsymbols = len(self.names)
+        keep = parents != children
+        pairs, merged = np.unique(parents[keep] * max(nsymbols, 1) + children[keep], return_inverse=True)
+        self.counts = np.bincount(merged, weights=counts[keep], minlength=pairs.size).astype(np.int64)
+        self.callees = pairs % max(nsymbols, 1)
+        self.offsets = np.zeros(nsymbols + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs // max(nsymbols, 1), minlength=nsymbols), out=self.offsets[1:])
+
+    def size(self):
+        return len(self.names)
+
+    def callers(self):
+        """caller id of every arc, aligned with callees and counts
+        """
+        return np.repeat(np.arange(self.size()), np.diff(self.offsets))
+
+    def calls_into(self):
+        """calls of every symbol over the arcs of the graph
+        """
+        return np.bincount(self.callees, weights=self.counts, minlength=self.size())
+
+    def propagate(self, self_cost):
+        """inclusive cost of every symbol: its self cost plus, for each callee, the share
+        of the callee's inclusive cost in proportion of the calls made to it, as gprof
+        propagates time to parents. As in gprof, a cycle is merged into one node whose
+        total is propagated to its callers outside the cycle, while each member reports
+        its own self cost plus the shares of its callees outside the cycle.
+        """
+        nsymbols = self.size()
+        self_cost = np.asarray(self_cost, dtype=np.float64)
+        if nsymbols == 0:
+            return self_cost.copy()
+        graph = csr_matrix((np.ones(self.callees.size), self.callees, self.offsets), shape=(nsymbols, nsymbols))
+        ncycles, labels = connected_components(graph, directed=True, connection='strong')
+        callers = labels[self.callers()]
+        callees = labels[self.callees]
+        external = callers != callees
+        callers, callees, counts = callers[external], callees[external], self.counts[external].astype(np.float64)
+        inclusive = np.bincount(labels, weights=self_cost, minlength=ncycles)
+        calls_in = np.bincount(callees, weights=counts, minlength=ncycles)
+
+        #visit callees before their callers over the condensed graph, which is acyclic
+        order = np.argsort(callees, kind='stable')
+        arc_offsets = np.zeros(ncycles + 1, dtype=np.int64)
+        np.cumsum(np.bincount(callees, minlength=ncycles), out=arc_offsets[1:])
+        arc_callers = callers[order].tolist()
+        arc_counts = counts[order].tolist()
+        pending = np.bincount(callers, minlength=ncycles).tolist()
+        ready = [cycle for cycle in range(ncycles) if pending[cycle] == 0]
+        inclusive_list = inclusive.tolist()
+        calls_list = calls_in.tolist()
+        while ready:
+            cycle = ready.pop()
+            for arc in range(arc_offsets[cycle], arc_offsets[cycle + 1]):
+                caller = arc_callers[arc]
+                #arcs of count 0, as gprof may list, pass no share
+                if calls_list[cycle] > 0:
+                    inclusive_list[caller] += inclusive_list[cycle] * arc_counts[arc] / calls_list[cycle]
+                pending[caller] -= 1
+                if pending[caller] == 0:
+                    ready.append(caller)
+        inclusive = np.array(inclusive_list)[labels]
+
+        members = np.bincount(labels, minlength=ncycles)[labels] > 1
+        if members.any():
+            arc_callers = self.callers()
+            outside = labels[arc_callers] != labels[self.callees]
+            callee_labels = labels[self.callees[outside]]
+            shares = np.zeros(callee_labels.size)
+            called = calls_in[callee_labels] > 0
+            shares[called] = np.array(inclusive_list)[callee_labels[called]] * self.counts[outside][called] / calls_in[callee_labels[called]]
+            member_cost = self_cost + np.bincount(arc_callers[outside], weights=shares, minlength=nsymbols)
+            inclusive[members] = member_cost[members]
+        return inclusive
+
+    def heaviest_path(self, inclusive, start):
+        """from start, follow the callee passing the largest share of inclusive cost
+        """
+        calls_in = self.calls_into()
+        path = [start]
+        visited = {start}
+        current = start
+        while True:
+            begin, end = self.offsets[current], self.offsets[current + 1]
+            if begin == end:
+                break
+            callees = self.callees[begin:end]
+            shares = np.zeros(callees.size)
+            called = calls_in[callees] > 0
+            shares[called] = inclusive[callees[called]] * self.counts[begin:end][called] / calls_in[callees[called]]
+            best = int(np.argmax(shares))
+            current = int(callees[best])
+            if shares[best] <= 0 or current in visited:
+                break
+            path.append(current)
+            visited.add(current)
+        return path
+
+def call_graph(gmon, symtab):
+    """call graph of the arcs of a gmon file between the text symbols
+    """
+    if gmon.arcs.size == 0:
+        return CallGraph([], [], [])
+    parents = symtab.lookup(gmon.arcs['from_pc'])
+    children = symtab.lookup(gmon.arcs['self_pc'])
+    valid = (parents >= 0) & (children >= 0)
+    names = symtab.names
+    return CallGraph([names[i] for i in parents[valid].tolist()], [names[i] for i in children[valid].tolist()],
+        gmon.arcs['count'][valid])
+
+def flat_profile(gmon, symtab, graph=None):
+    """build the rows of the gprof flat profile:
+    [% time, cumulative seconds, self seconds, calls, self s/call, total s/call, name]
+    per-call times are reported in seconds; total s/call adds the time of the
+    children propagated over the call graph.
+    """
+    ticks = np.zeros(len(symtab.names), dtype=np.float64)
+    total_ticks = 0.0
+    for hist_hdr, bins in gmon.hists:
+        ticks += symtab.assign_samples(hist_hdr, bins)
+        total_ticks += float(bins.sum(dtype=np.int64))
+
+    calls = np.zeros(len(symtab.names), dtype=np.int64)
+    if gmon.arcs.size > 0:
+        parents = symtab.lookup(gmon.arcs['from_pc'])
+        children = symtab.lookup(gmon.arcs['self_pc'])
+        #recursive calls are not counted as calls in the flat profile
+        valid = (parents >= 0) & (children >= 0) & (parents != children)
+        np.add.at(calls, children[valid], gmon.arcs['count'][valid].astype(np.int64))
+
+    if graph is None:
+        graph = call_graph(gmon, symtab)
+    graph_ids = np.array([graph.ids.get(name, -1) for name in symtab.names], dtype=np.int64)
+    in_graph = graph_ids >= 0
+    graph_ticks = np.zeros(graph.size())
+    graph_ticks[graph_ids[in_graph]] = ticks[in_graph]
+    inclusive_ticks = ticks.copy()
+    inclusive_ticks[in_graph] = graph.propagate(graph_ticks)[graph_ids[in_graph]]
+
+    hz = float(gmon.prof_rate()) or 1.0
+    listed = np.flatnonzero((ticks > 0) | (calls > 0))
+    order = sorted(listed, key=lambda i: (-ticks[i], -calls[i], symtab.names[i]))
+    rows = []
+    accum = 0.0
+    for i in order:
+        accum += ticks[i]
+        self_time = ticks[i] / hz
+        per_call = self_time / calls[i] if calls[i] > 0 else 0.0
+        total_per_call = inclusive_ticks[i] / hz / calls[i] if calls[i] > 0 else 0.0
+        percentage = 100 * ticks[i] / total_ticks if total_ticks > 0 else 0.0
+        #round the same way as the printed gprof report
+        rows.append([float(f'{percentage:.2f}'), float(f'{accum / hz:.2f}'), float(f'{self_time:.2f}'), int(calls[i]),
+            float(per_call), float(total_per_call), symtab.names[i]])
+    return rows
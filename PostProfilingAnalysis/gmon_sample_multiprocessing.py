@@ -10,6 +10,10 @@ from collections import namedtuple
 import operator
 from multiprocessing import Pool, cpu_count
 
+import numpy as np
+
+from gmon_reader import GmonFile, CallGraph, call_graph, flat_profile, load_symbol_table
+
 hist_entry = namedtuple('hist_entry', \
         'total_percentage,\
         total_time,\
@@ -19,6 +23,22 @@ hist_entry = namedtuple('hist_entry', \
         self_per_call,\
         symbol')
 
+#per symbol statistics of the attributes over the samples of a gmonSamples,
+#arrays of (symbols x attributes) except count, percentiles maps q to its array
+HistStatistics = namedtuple('HistStatistics', ['symbols', 'count', 'mean', 'median', 'percentiles', 'variance'])
+
+def sorted_percentile(ordered, count, q):
+    """q-th percentile with linear interpolation along the first axis of ordered,
+    whose first count[j] rows of column j are the sorted values of the column
+    """
+    position = (np.maximum(count, 1) - 1) * (q / 100.)
+    low = np.floor(position).astype(np.int64)
+    high = np.minimum(low + 1, np.maximum(count - 1, 0))
+    fraction = (position - low)[:, None]
+    low_values = np.take_along_axis(ordered, low[None, :, None], axis=0)[0]
+    high_values = np.take_along_axis(ordered, high[None, :, None], axis=0)[0]
+    return low_values + (high_values - low_values) * fraction
+
 class histEntry:
     def __init__(self, args):
         val = hist_entry(*args)
@@ -61,20 +81,61 @@ class gmonSample:
         self.bin = binfile
         self.entries = []
         self.hist_dict = {}
+        self.prof_rate = 0 #histogram samples per second
+        self.call_graph = CallGraph([], [], [])
         self.parse()
 
     def parse(self):
+        """decode the gmon.out histogram and arcs directly, falling back to gprof
+        for files the native reader does not understand
+        """
+        try:
+            gmon = GmonFile(self.infile)
+            symtab = load_symbol_table(self.bin)
+        except Exception as ex:
+            print(f'native gmon reader failed on {self.infile}: {ex}, fall back to gprof')
+            self.parse_gprof()
+            return
+        self.prof_rate = gmon.prof_rate()
+        self.call_graph = call_graph(gmon, symtab)
+        for fields in flat_profile(gmon, symtab, self.call_graph):
+            entry = histEntry(fields)
+            self.entries.append(entry)
+            self.hist_dict[entry.symbol] = entry
+
+    def parse_gprof(self):
         cmd = '/usr/bin/gprof ' + self.bin + ' ' + self.infile
         args = shlex.split(cmd)
         is_entry = False
+        flat_done = False
+        is_graph = False
+        arcs = []
+        block = []
         with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
             for line in io.TextIOWrapper(proc.stdout, encoding="utf-8"):
-                if re.search('time', line) and re.search('s/call', line):
+                period = re.search(r'Each sample counts as ([.\d]+) seconds', line)
+                if period and float(period.group(1)) > 0:
+                    self.prof_rate = round(1 / float(period.group(1)))
+                    continue
+                if not flat_done and re.search('time', line) and re.search('s/call', line):
                     is_entry = True
                     continue
                 if re.search('the percentage of the total running time of the', line):
                     is_entry = False
-                    break
+                    flat_done = True
+                    continue
+                if re.search(r'index\s+% time\s+self\s+children', line):
+                    is_graph = True
+                    continue
+                if is_graph:
+                    if re.search('This table describes the call tree of the program', line) or line.startswith('\f'):
+                        is_graph = False
+                    elif line.startswith('---'):
+                        arcs.extend(self.parent_arcs(block))
+                        block = []
+                    else:
+                        block.append(line)
+                    continue
                 if is_entry == False:
                     continue
                 func = 'invalid'
@@ -96,6 +157,29 @@ class gmonSample:
                 entry = histEntry(fields)
                 self.entries.append(entry)
                 self.hist_dict[entry.symbol] = entry
+        if len(arcs) > 0:
+            self.call_graph = CallGraph(*zip(*arcs))
+
+    def parent_arcs(self, block):
+        """(caller, callee, count) arcs of one entry of the gprof call graph: the lines
+        above the primary line [index] are its callers, with called as count/total.
+        Callers within the cycle of the entry, and recursive calls, are listed with a
+        bare count; the entry of a cycle as a whole only repeats the arcs of its members.
+        """
+        arcs = []
+        for index, line in enumerate(block):
+            primary = re.search(r'^\[\d+\]\s+[.\d]+\s+[.\d]+\s+[.\d]+\s+[\d+]*\s*(.*?)\s+(<cycle \d+>\s+)?\[\d+\]\s*$', line)
+            if not primary:
+                continue
+            callee = primary.group(1)
+            if re.search(r'^<cycle \d+ as a whole>$', callee):
+                break
+            for parent in block[:index]:
+                ret = re.search(r'^\s+(?:[.\d]+\s+[.\d]+\s+)?(\d+)(?:/\d+)?\s+(.*?)\s+(<cycle \d+>\s+)?\[\d+\]\s*$', parent)
+                if ret:
+                    arcs.append((ret.group(2), callee, int(ret.group(1))))
+            break
+        return arcs
 
     def get_hist_dict(self):
         return self.hist_dict
@@ -114,6 +198,7 @@ class gmonSamples:
         self.samples = []
         self.collect_files()
         self.size = len(self.files_analyze)
+        self.check_bin()
         self.parse()
         # aggregate
         self.attribute_list = ['total_percentage', \
@@ -128,11 +213,18 @@ class gmonSamples:
         self.size = len(self.samples)
         return self.size
 
-    def parse_gmon_file(self, datafile):
+    def check_bin(self):
+        """resolve the binary and build its symbol table once in the parent,
+        so the workers forked by parse() share it
+        """
         if not os.path.isfile(self.bin):
             self.bin = self.dir + self.bin
         if not os.path.isfile(self.bin):
             print('{} is not valid execution for gprof'.format(self.bin))
+            return
+        load_symbol_table(self.bin)
+
+    def parse_gmon_file(self, datafile):
         return gmonSample(datafile, self.bin)
 
     def collect_files(self):
@@ -152,27 +244,65 @@ class gmonSamples:
     def get_samples(self):
         return self.samples
 
-    def aggregate(self):
-        key_count = defaultdict(lambda:0)
-        self.hist_dict.clear()
+    def hist_matrix(self):
+        """the flat profiles of all samples as one (samples x symbols x attributes) array,
+        symbols in order of first appearance; attributes of a symbol missing from a
+        sample are nan
+        """
+        symbols = {}
+        rows = []
+        get_attributes = operator.attrgetter(*self.attribute_list)
         for sample in self.samples:
             local_hist = sample.get_hist_dict()
-            for key in local_hist:
-                if not key in self.hist_dict:
-                    self.hist_dict[key] = local_hist[key]
-                    key_count[key] = 1
-                else:
-                    for attribute in self.attribute_list:
-                        old_val = self.hist_dict[key].get_attr(attribute)
-                        self.hist_dict[key].set_attr(attribute, old_val + local_hist[key].get_attr(attribute))
-                    key_count[key] = key_count[key] + 1
+            ids = [symbols.setdefault(key, len(symbols)) for key in local_hist]
+            values = np.array([get_attributes(entry) for entry in local_hist.values()], dtype=np.float64)
+            rows.append((ids, values.reshape(len(ids), len(self.attribute_list))))
+        matrix = np.full((len(self.samples), len(symbols), len(self.attribute_list)), np.nan)
+        for index, (ids, values) in enumerate(rows):
+            matrix[index, ids] = values
+        return list(symbols), matrix
 
-        for key in key_count:
-            if key_count[key] <= 1:
-                continue
-            for attribute in self.attribute_list:
-                val = self.hist_dict[key].get_attr(attribute) / key_count[key]
-                self.hist_dict[key].set_attr(attribute, val)
+    def hist_statistics(self, percentiles=(90,), statistics=('mean', 'median', 'percentiles', 'variance')):
+        """count, mean, median, percentiles and variance of every attribute per symbol,
+        over the samples where the symbol appears; statistics not listed are None
+        """
+        symbols, matrix = self.hist_matrix()
+        present = ~np.isnan(matrix)
+        count = present[:, :, 0].sum(axis=0)
+        divisor = np.maximum(count, 1)[:, None]
+        #summed in sample order, as when the samples were merged one at a time
+        mean = np.where(present, matrix, 0.0).sum(axis=0) / divisor
+        median = quantiles = variance = None
+        if 'median' in statistics or 'percentiles' in statistics:
+            #nan sorts last, the samples of a symbol are the first count rows
+            ordered = np.sort(matrix, axis=0)
+            if 'median' in statistics:
+                median = sorted_percentile(ordered, count, 50)
+            if 'percentiles' in statistics:
+                quantiles = {q: sorted_percentile(ordered, count, q) for q in percentiles}
+        if 'variance' in statistics:
+            variance = np.where(present, (matrix - mean) ** 2, 0.0).sum(axis=0) / divisor
+        return HistStatistics(symbols, count, mean, median, quantiles, variance)
+
+    def aggregate(self, statistic='mean', percentile=90):
+        """one histEntry per symbol holding a statistic of its attributes over the
+        samples: 'mean', 'median', 'percentile' or 'variance'. The entries of the
+        samples are left untouched.
+        """
+        if statistic == 'percentile':
+            stats = self.hist_statistics((percentile,), ('percentiles',))
+            values = stats.percentiles[percentile]
+        else:
+            stats = self.hist_statistics((), (statistic,))
+            values = getattr(stats, statistic)
+        calls_index = self.attribute_list.index('calls')
+        self.hist_dict = {}
+        for symbol, fields in zip(stats.symbols, values.tolist()):
+            entry = histEntry(fields + [symbol])
+            #histEntry truncates calls, keep the fraction of an average
+            calls = fields[calls_index]
+            entry.calls = int(calls) if calls.is_integer() else calls
+            self.hist_dict[symbol] = entry
         return self.hist_dict
 
     def print_aggregate(self):
@@ -186,13 +316,15 @@ if __name__ == '__main__':
     parser.add_argument('--norms', required=True, help='')
     parser.add_argument('--bugs', required=True, help='')
     parser.add_argument('--max', default = 100, help ='maximum number of samples supported to process')
+    parser.add_argument('--statistic', default='mean', choices=['mean', 'median', 'percentile', 'variance'], help='statistic of the aggregated histograms')
+    parser.add_argument('--percentile', default=90, help='percentile of --statistic percentile')
     args = parser.parse_args()
 
     print('==================norm cases=================')
     norm_samples = gmonSamples(args.norms, args.bin, int(args.max))
-    norm_samples.aggregate()
+    norm_samples.aggregate(args.statistic, float(args.percentile))
     norm_samples.print_aggregate()
     print('==================bug cases=================')
     bug_samples = gmonSamples(args.bugs, args.bin, int(args.max))
-    bug_samples.aggregate()
+    bug_samples.aggregate(args.statistic, float(args.percentile))
     bug_samples.print_aggregate()
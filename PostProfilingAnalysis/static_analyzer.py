@@ -8,6 +8,8 @@ import re
 from collections import namedtuple
 import struct
 import operator
+import hashlib
+import numpy as np
 
 # If pyelftools is not installed, the example can also run from the root or
 # examples/ dir of the source distribution.
@@ -28,6 +30,109 @@ line_index = 3
 symbol_index = 4
 max_ip_offset = 6
 AddressEntry = namedtuple('AddressEntry', ['begin', 'end', 'file', 'line'])
+#bump when the layout of the cached address map changes
+ADDRESS_CACHE_VERSION = 1
+
+class AddressLookup:
+    """Line table of a binary as sorted begin/end arrays with interned file names.
+    Plain numpy arrays, so one lookup can be pickled or inherited by every worker
+    that decodes samples of the same binary.
+    """
+    def __init__(self, addr_map, paths=None):
+        self.file_names = []
+        file_index = {}
+        file_ids = []
+        for entry in addr_map:
+            if entry.file not in file_index:
+                file_index[entry.file] = len(self.file_names)
+                self.file_names.append(entry.file)
+            file_ids.append(file_index[entry.file])
+        self.begins = np.array([entry.begin for entry in addr_map], dtype=np.int64)
+        self.ends = np.array([entry.end for entry in addr_map], dtype=np.int64)
+        self.lines = np.array([entry.line for entry in addr_map], dtype=np.int64)
+        self.file_ids = np.array(file_ids, dtype=np.int32)
+        self.paths = dict(paths or {})
+        self.index()
+
+    def index(self):
+        #running maximum of the ends, to find the first entry still covering an address
+        self.max_ends = np.maximum.accumulate(self.ends) if self.ends.size > 0 else self.ends
+
+    def save(self, cache_file):
+        """write the arrays to cache_file; the file is written under a temporary
+        name and renamed, so concurrent runs never read a partial cache
+        """
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, version=np.array(ADDRESS_CACHE_VERSION),
+                begins=self.begins, ends=self.ends, lines=self.lines, file_ids=self.file_ids,
+                file_names=np.array(self.file_names, dtype=str),
+                path_keys=np.array(list(self.paths.keys()), dtype=str),
+                path_values=np.array(list(self.paths.values()), dtype=str))
+        os.replace(tmp_file, cache_file)
+
+    @classmethod
+    def load(cls, cache_file):
+        with np.load(cache_file, allow_pickle=False) as data:
+            if int(data['version']) != ADDRESS_CACHE_VERSION:
+                raise ValueError(f'{cache_file}: cache version {int(data["version"])} != {ADDRESS_CACHE_VERSION}')
+            lookup = cls([])
+            lookup.begins = data['begins'].astype(np.int64)
+            lookup.ends = data['ends'].astype(np.int64)
+            lookup.lines = data['lines'].astype(np.int64)
+            lookup.file_ids = data['file_ids'].astype(np.int32)
+            lookup.file_names = data['file_names'].tolist()
+            lookup.paths = dict(zip(data['path_keys'].tolist(), data['path_values'].tolist()))
+        lookup.index()
+        return lookup
+
+    def __len__(self):
+        return self.begins.size
+
+    def resolve(self, addresses):
+        """map a batch of addresses to (lines, file_ids), -1 where no entry matches.
+        An address belongs to the first entry in begin order with
+        begin <= address and end > address - max_ip_offset.
+        """
+        addresses = np.asarray(addresses, dtype=np.int64)
+        candidates = np.searchsorted(self.begins, addresses, side='right')
+        first = np.searchsorted(self.max_ends, addresses - max_ip_offset, side='right')
+        found = first < candidates
+        index = np.where(found, first, 0)
+        if self.begins.size == 0:
+            return np.full(addresses.size, -1, dtype=np.int64), np.full(addresses.size, -1, dtype=np.int32)
+        return np.where(found, self.lines[index], -1), np.where(found, self.file_ids[index], -1)
+
+#one lookup per binary and set of source files, shared by the layouts of all sample files
+#and inherited by forked workers when it is built before the pool starts
+address_lookups = {}
+binary_ids = {}
+
+def binary_id(exec_file):
+    """identify a binary by its GNU build-id, or by mtime and size when it has none
+    """
+    stat = os.stat(exec_file)
+    key = (os.path.realpath(exec_file), stat.st_mtime_ns, stat.st_size)
+    if key not in binary_ids:
+        binary_ids[key] = read_binary_id(exec_file)
+    return binary_ids[key]
+
+def read_binary_id(exec_file):
+    with open(exec_file, 'rb') as f:
+        elffile = ELFFile(f)
+        section = elffile.get_section_by_name('.note.gnu.build-id')
+        if section is not None:
+            for note in section.iter_notes():
+                if note['n_type'] == 'NT_GNU_BUILD_ID':
+                    return note['n_desc']
+    stat = os.stat(exec_file)
+    return f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
+def address_cache_file(cache_dir, exec_file, paths):
+    """the cached address map depends on the binary and on the source files it covers
+    """
+    digest = hashlib.blake2b(repr(sorted(paths.items())).encode(), digest_size=8).hexdigest()
+    return os.path.join(cache_dir, f'addr_map.{binary_id(exec_file)}.{digest}.npz')
 
 class ValueFlow:
     def __init__(self, schema_file):
@@ -71,18 +176,20 @@ class ValueFlow:
         return value_flow_dict
 
 class Layout:
-    def __init__(self, conf_file, exec_file):
+    def __init__(self, conf_file, exec_file, cache_dir=None):
         self.conf_file = conf_file
         self.exec_file = exec_file
+        #the address map cache lives next to the layout files unless told otherwise
+        self.cache_dir = cache_dir if cache_dir else os.path.dirname(os.path.abspath(conf_file))
         self.value_flow = ValueFlow(conf_file)
         self.path = {}
         self.addr_map = []
+        self.lookup = AddressLookup([])
+        self.dwarfinfo = None
         self.schema_meta_items = []
         self.parse_schema_meta()
         if self.exec_file and os.path.isfile(self.exec_file):
-            self.process_elf()
-        else:
-            self.dwarfinfo = None
+            self.load_lookup()
         self.value_flow_dict = self.value_flow.parse_value_flow()
 
     def parse_schema_meta(self):
@@ -109,6 +216,44 @@ class Layout:
     def get_schema_meta(self):
         return self.schema_meta_items
     
+    def load_lookup(self):
+        """reuse the address lookup of the binary if another layout already built it;
+        copies of the same build share it through the build-id
+        """
+        try:
+            key = (binary_id(self.exec_file), frozenset(self.path.items()))
+        except Exception:
+            key = (os.path.realpath(self.exec_file), frozenset(self.path.items()))
+        if key not in address_lookups:
+            address_lookups[key] = self.load_cached_lookup()
+        self.lookup = address_lookups[key]
+
+    def load_cached_lookup(self):
+        """read the address map from the on-disk cache, or decode the DWARF
+        info and write the cache for later runs
+        """
+        try:
+            cache_file = address_cache_file(self.cache_dir, self.exec_file, self.path)
+        except Exception as ex:
+            print(f'address map cache disabled for {self.exec_file}: {ex}')
+            cache_file = None
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                lookup = AddressLookup.load(cache_file)
+                if lookup.paths == self.path:
+                    return lookup
+            except Exception as ex:
+                print(f'ignore address map cache {cache_file}: {ex}')
+
+        self.process_elf()
+        lookup = AddressLookup(self.addr_map, self.path)
+        if cache_file and self.dwarfinfo is not None:
+            try:
+                lookup.save(cache_file)
+            except OSError as ex:
+                print(f'fail to write address map cache {cache_file}: {ex}')
+        return lookup
+
     def process_elf(self):
         """get_dwarf_info returns a DWARFInfo context object, which is the
         ostarting point for all DWARF-based processing in pyelftools.
@@ -156,36 +301,17 @@ class Layout:
         self.addr_map.sort(key = lambda x: x[0])
 
     def decode_files_lines(self, addresses):
-        def next_addr(index):
-            index = index + 1
-            if index < len(addresses):
-                return index
-            return -1
-
         map_to_line = {}
         map_to_file = {}
-        if len(self.addr_map) == 0:
+        if len(self.lookup) == 0:
             print('Address map(line prog) is not initialized')
             return map_to_line, map_to_file
 
-        addresses.sort()
-        index = 0
-        address = addresses[index]
-        for entry in self.addr_map:
-            if address - max_ip_offset > entry.end:
-                continue
-            while address < entry.begin:
-                index = next_addr(index)
-                if index == -1:
-                    return map_to_line, map_to_file
-                address = addresses[index]
-            while entry.begin <= address and entry.end > address - max_ip_offset:
-                map_to_file[address] = entry.file
-                map_to_line[address] = entry.line
-                index = next_addr(index)
-                if index == -1:
-                    return map_to_line, map_to_file
-                address = addresses[index]
+        lines, file_ids = self.lookup.resolve(addresses)
+        for address, line, file_id in zip(np.asarray(addresses).tolist(), lines.tolist(), file_ids.tolist()):
+            if file_id >= 0:
+                map_to_line[address] = line
+                map_to_file[address] = self.lookup.file_names[file_id]
         return map_to_line, map_to_file
 
     def attach_value_flow(self, var_desc, value_sample):
@@ -0,0 +1,89 @@
+import os
+import hashlib
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Results of the statistics of the discount calculator (Anderson-Darling tests,
+# Hellinger distances, range outliers) addressed by a hash of their input arrays and
+# parameters. Recent results are kept in memory; with a directory, every result is
+# also written to disk so that re-runs with other thresholds or indexes reuse them.
+
+#bump when a cached result changes for the same inputs
+STATS_CACHE_VERSION = 1
+#marks a key missing from the cache, as None is a valid result
+missing = object()
+
+def array_digest(array):
+    """hash of the dtype, the shape and the content of an array
+    """
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{array.dtype.str}{array.shape}'.encode())
+    digest.update(array.data if array.size > 0 else b'')
+    return digest.digest()
+
+class StatsCache:
+    """LRU cache of capacity results in memory, over an optional directory of
+    pickled results
+    """
+    def __init__(self, capacity=4096, directory=None):
+        self.capacity = capacity
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, kind, params, *digests):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((STATS_CACHE_VERSION, kind, params)).encode())
+        for array in digests:
+            digest.update(array)
+        return digest.hexdigest()
+
+    def cache_file(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.pkl')
+
+    def get(self, key, default=missing):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        if self.directory:
+            try:
+                with open(self.cache_file(key), 'rb') as f:
+                    value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+            else:
+                self.remember(key, value)
+                with self.lock:
+                    self.hits += 1
+                return value
+        with self.lock:
+            self.misses += 1
+        return default
+
+    def remember(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def put(self, key, value):
+        self.remember(key, value)
+        if not self.directory:
+            return
+        cache_file = self.cache_file(key)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
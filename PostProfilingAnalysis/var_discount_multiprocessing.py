@@ -8,23 +8,160 @@ import argparse
 import re
 from collections import namedtuple
 import operator
+import math
+import zlib
+import hashlib
+import pickle
+import copy
 
 import numpy as np
+import scipy
 import statistics
 from scipy.stats import ks_2samp
-from scipy.stats import anderson_ksamp
 from scipy.spatial.distance import euclidean
 from concurrent.futures import ThreadPoolExecutor
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count, get_context
 import warnings
 import random
 warnings.filterwarnings("ignore")
 
 from static_analyzer import key_desc, regx_desc, func_index, symbol_index
-from var_sample_multiprocessing import VarSample, VarSamples
+from var_sample_multiprocessing import VarSample, VarSamples, sampling_period
+from batched_stats import anderson_2samp_batch, per_call
+from stats_cache import StatsCache, array_digest, missing
 
 discount_entry = namedtuple('discount_entry', 'dir, file, function, line, symbol, type, usage, discount, default')
 insane_map={'proc', 'pid', 'thread', 'tid', 'time'}
+#histograms (distinct values, counts) of the arrays compared for one descriptor
+DescSummary = namedtuple('DescSummary', ['count', 'values', 'deltas', 'durations'])
+#comparison of the bug sample to one norm sample on a descriptor; weight is the number of norm samples
+NormComparison = namedtuple('NormComparison', ['discount', 'outlier', 'dimension', 'non_fault', 'weight'])
+#bump when the comparisons kept in the norm cache change
+NORM_CACHE_VERSION = 1
+sample_duration = 5 #ms
+#descriptor batches per worker of the process engine
+batches_per_worker = 4
+
+#runs up to this length are summed position by position across all runs,
+#longer ones one at a time; either way in the same order as a sequential sum
+short_run = 32
+
+def duration_array(samples, sample_duration=sample_duration):
+    """Estimate the processing time for individual value in the variable sample list.
+    Convert the us in timestamp into ms in delta.
+    Return the duration array and the array of corresponding values
+    A run of equal consecutive values lasts sample_duration plus the timestamp deltas
+    inside the run; the deltas are added left to right, so the durations are bit for
+    bit the ones of a sequential loop.
+    """
+    if len(samples) == 0:
+        return np.array([]), np.array([])
+    values = value_array(samples)
+    seqids = np.asarray(samples.seqid).astype(np.int64)
+    ends = np.append(np.flatnonzero(values[1:] != values[:-1]), values.size - 1)
+    starts = np.append(0, ends[:-1] + 1)
+    lengths = ends - starts + 1
+    vals = values[ends]
+    if lengths.max() == 1:
+        return np.full(ends.size, sample_duration), vals
+
+    deltas = np.zeros(values.size, dtype=np.float64)
+    deltas[1:] = np.diff(seqids) / 1000
+    result = np.full(ends.size, sample_duration, dtype=np.float64)
+    for position in range(1, min(int(lengths.max()), short_run)):
+        runs = np.flatnonzero(lengths > position)
+        result[runs] += deltas[starts[runs] + position]
+    for run in np.flatnonzero(lengths > short_run):
+        #accumulate is a sequential scan, unlike the pairwise np.sum
+        partial = np.concatenate(([result[run]], deltas[starts[run] + short_run:ends[run] + 1]))
+        result[run] = np.add.accumulate(partial)[-1]
+    return result, vals
+
+def value_array(samples):
+    """Extract the values from the sample array
+    as int64, or uint64 when a value does not fit into int64
+    """
+    values = np.asarray(samples.val)
+    if values.size == 0:
+        return np.array([])
+    if values.dtype.kind == 'u' and values.max() > np.iinfo(np.int64).max:
+        return values.astype(np.uint64)
+    return values.astype(np.int64)
+
+def delta_array(values):
+    """Extract delta of values from the sample array
+    """
+    if values.size == 0:
+        return np.array([])
+    result = np.empty_like(values)
+    result[0] = 0
+    np.subtract(values[1:], values[:-1], out=result[1:])
+    return result
+
+#c(alpha) of the two-sample Kolmogorov-Smirnov critical distance at alpha = 0.05
+ks_coefficient = 1.358
+
+def ks_critical_distance(n, m):
+    return ks_coefficient * math.sqrt((n + m) / (n * m))
+
+def stratified_indexes(size, cap, seed):
+    """indexes of cap samples out of size time ordered ones: the samples are cut into
+    cap strata of consecutive samples and one is drawn from each stratum
+    """
+    bounds = np.linspace(0, size, cap + 1).astype(np.int64)
+    rng = np.random.default_rng(seed)
+    return bounds[:-1] + (rng.random(cap) * (bounds[1:] - bounds[:-1])).astype(np.int64)
+
+def capture_sample_duration(sample, default=sample_duration):
+    """time in ms a sample of the capture stands for, from the profiling rate in its
+    header; default for captures without one
+    """
+    period = sampling_period(getattr(sample, 'prof_rate', 0))
+    return period * 1000 if period else default
+
+def histogram(array):
+    return np.unique(array, return_counts=True)
+
+def expand_histogram(hist):
+    return np.repeat(*hist)
+
+class VarSampleSummary:
+    """What the discount calculator reads from a norm sample: per descriptor histograms of
+    the values, value deltas and processing durations. The tests and distances on them
+    only depend on the multiset of each array, so the expanded (sorted) histograms give
+    the same discounts as the arrays of the full sample. Built by the parsing workers in
+    streaming mode, so that only the summaries are sent back to the parent.
+    """
+    def __init__(self, sample):
+        self.datafile = sample.datafile
+        self.layout_file = sample.layout_file
+        self.schema_descs = sample.schema_descs
+        self.prof_rate = sample.prof_rate
+        self.summaries = {}
+        for desc in sample.schema_descs.values():
+            samples = sample.unfold_samples_for_desc(desc)
+            values = value_array(samples)
+            durations, _ = duration_array(samples, capture_sample_duration(sample))
+            self.summaries[desc] = DescSummary(len(samples), histogram(values), histogram(delta_array(values)), histogram(durations))
+            sample.invalidate_unfolded_samples(desc)
+
+    def arrays(self, desc):
+        summary = self.summaries.get(desc)
+        if summary is None:
+            return np.array([]), np.array([]), np.array([])
+        return expand_histogram(summary.values), expand_histogram(summary.deltas), expand_histogram(summary.durations)
+
+    def thread_view(self, thread):
+        """the summaries keep no tids, so every thread is compared to the whole capture
+        """
+        return self
+
+    def display_samples(self, outfile):
+        with open(outfile, 'a') as f:
+            for desc, summary in self.summaries.items():
+                f.write(f'{self.datafile}')
+                f.write(f'{desc}\n')
+                f.write(f'    samples = {summary.count}, distinct values = {summary.values[0].size}, distinct durations = {summary.durations[0].size}\n')
 
 class VarDiscountCalculator():
     """Calculate discount ratio with variable samples from buggy cases and baselines.
@@ -34,10 +171,11 @@ class VarDiscountCalculator():
     default discount means the null hypothesis is not rejected, so we thought they are similar
     in distribution.
     """
-    sample_duration = 5 #ms
+    sample_duration = sample_duration
     def __init__(self, norm_vars, bug_vars, index):
         norm_index = random.randrange(len(norm_vars.samples))
         self.norms = norm_vars.samples[norm_index:norm_index + 1]
+        self.all_norms = norm_vars.samples
         self.bugs = bug_vars.samples[index:index + 1]
         self.bug_schemas = bug_vars.schemas
         self.norm_schemas = norm_vars.schemas
@@ -47,6 +185,18 @@ class VarDiscountCalculator():
         self.pvalue = 0.05
         self.validate_discount = 0.1
         self.default_discount = 0.8
+        self.reset_discounts()
+        self.engine = 'thread'
+        self.workers = None
+        self.stats = 'batched'
+        self.duration_bins = None
+        self.aggregate = 'median'
+        self.norm_cache = None
+        self.max_samples = None
+        self.seed = 0
+        self.stats_cache = StatsCache()
+
+    def reset_discounts(self):
         #calculate discount for variables
         self.discount_on_var = {}
         self.discount_on_func = {}
@@ -54,6 +204,22 @@ class VarDiscountCalculator():
         self.desc_to_func = defaultdict(lambda:None)
         self.annotate_on_func = {}
         self.global_vars = []
+        self.norm_results = {} #id(norm sample) -> {desc_key: NormComparison}
+        self.arrays = {} #(id(sample), desc) -> arrays compared for desc
+        self.full_sizes = {} #(id(sample), desc) -> sizes of the arrays before subsampling
+        self.subsample_notes = {}
+        self.pvalues = {} #(id(norm array), id(bug array)) -> batched test result
+        self.digests = {} #id(array) -> (array, content hash)
+
+    def thread_calculator(self, thread):
+        """a calculator with the same settings comparing thread class thread of the
+        bug sample to the same class of the norm samples; the statistics cache is shared
+        """
+        calculator = copy.copy(self)
+        calculator.reset_discounts()
+        calculator.norms = [norm_sample.thread_view(thread) for norm_sample in self.norms]
+        calculator.all_norms = [norm_sample.thread_view(thread) for norm_sample in self.all_norms]
+        return calculator
 
     def set_default_discount(self, rate):
         self.default_discount = rate
@@ -92,36 +258,29 @@ class VarDiscountCalculator():
         #stat_ks_2sample, pvalue_ks_2sample = ks_2samp(norm, bug)
         #if pvalue_ks_2sample < self.pvalue:
            # return True
-        try:
-            stat, critical_values, pvalue = anderson_ksamp([np.asarray(norm), np.asarray(bug)])
-            if pvalue < self.pvalue: 
-                return True
-        except Exception as ex:
-            pass
+        tested = self.pvalues.get((id(norm), id(bug)), missing)
+        if tested is missing:
+            tested = self.memoized('anderson', scipy.__version__, norm, bug, lambda: per_call(norm, bug))
+        #None when anderson_ksamp rejects the arrays
+        if tested is not None and tested.pvalue < self.pvalue:
+            return True
         return False
 
-    def hellinger_distance(self, norm, bug):
+    def hellinger_distance(self, norm, bug, bins=None):
         """calculate a minimal discount since null hypothesis is rejected
+        The distributions are counted over the distinct values of both arrays, or over
+        bins equal-width bins spanning both arrays when bins is given.
         """
-        def distribute(samples):
-            values, counts = np.unique(samples, return_counts=True)
-            result = {}
-            for index in range(values.size):
-                result[values[index]] = float(counts[index]/samples.size)
-            return result
-
-        def align_array(dict1, dict2, values, default):
-            arr1 = []
-            arr2 = []
-            for val in values:
-                arr1.append(dict1.get(val, default))
-                arr2.append(dict2.get(val, default))
-            return np.array(arr1), np.array(arr2)
-
-        norm_dict = distribute(norm)
-        bug_dict = distribute(bug)
-        values = np.unique(np.concatenate([norm, bug]))
-        norm_dist, bug_dist = align_array(norm_dict, bug_dict, values, 0.0)
+        if bins:
+            edges = np.histogram_bin_edges(np.concatenate([norm, bug]), bins=bins)
+            norm_counts, _ = np.histogram(norm, bins=edges)
+            bug_counts, _ = np.histogram(bug, bins=edges)
+        else:
+            domain, inverse = np.unique(np.concatenate([norm, bug]), return_inverse=True)
+            norm_counts = np.bincount(inverse[:len(norm)], minlength=domain.size)
+            bug_counts = np.bincount(inverse[len(norm):], minlength=domain.size)
+        norm_dist = norm_counts / max(len(norm), 1)
+        bug_dist = bug_counts / max(len(bug), 1)
         _SQRT2 = np.sqrt(2)
         distance = euclidean(np.sqrt(norm_dist), np.sqrt(bug_dist)) / _SQRT2
         return distance
@@ -138,168 +297,234 @@ class VarDiscountCalculator():
         n_norm, c_norm = np.unique(norm, return_counts=True)
         maxnorm = np.amax(n_norm)
         minnorm = np.amin(n_norm)
-        bad_sample = 0
-        outliers = []
-        for i, val in enumerate(n_bug):
-            if val * self.threshold > maxnorm or val < minnorm * self.threshold:
-                bad_sample += c_bug[i]
-                outliers.append(val)
+        diverted = (n_bug * self.threshold > maxnorm) | (n_bug < minnorm * self.threshold)
+        bad_sample = c_bug[diverted].sum()
         diff = float(bad_sample/bug.size)
-        return diff, outliers
+        return diff, n_bug[diverted]
 
-    def duration_array(self, samples):
+    def duration_array(self, samples, sample_duration=None):
         """Estimate the processing time for individual value in the variable sample list.
         Convert the us in timestamp into ms in delta.
-        Return the duration array and corresponding values in a list
-        """
-        result = []
-        vals = []
-        if len(samples) == 0:
-            return np.array(result), vals
-        duration = self.sample_duration
-        for index in range(1, len(samples)):
-            if samples[index - 1].val == samples[index].val:
-                delta = (samples[index].seqid - samples[index - 1].seqid)/1000
-                duration = duration + delta
-            else:
-                vals.append(samples[index - 1].val)
-                result.append(duration)
-                duration = self.sample_duration
-        vals.append(samples[-1].val)
-        result.append(duration)
-        return np.array(result), vals
+        Return the duration array and the array of corresponding values
+        """
+        return duration_array(samples, sample_duration or self.sample_duration)
 
     def value_array(self, samples):
         """Extract the values from the sample array
         """
-        result = []
-        for item in samples:
-            result.append(item.val)
-        return np.array(result)
+        return value_array(samples)
 
     def delta_array(self, values):
         """Extract delta of values from the sample array
         """
-        result = []
-        if values.size == 0:
-            return np.array(result)
-        prev_value = values[0]
-        for i, value in enumerate(values):
-            result.append(value - prev_value)
-            prev_value = value
-        return np.array(result)
+        return delta_array(values)
 
-    def similar(self, norm, bug):
+    def sample_arrays(self, sample, desc):
+        """return (values, deltas, durations, duration values) of a sample on desc,
+        computed once per sample and desc; streamed norm samples only keep the
+        histograms of the first three arrays
+        """
+        key = (id(sample), desc)
+        if key not in self.arrays:
+            if isinstance(sample, VarSampleSummary):
+                values, deltas, durations = sample.arrays(desc)
+                vals = np.array([])
+            else:
+                samples = sample.unfold_samples_for_desc(desc)
+                values = self.value_array(samples)
+                deltas = self.delta_array(values)
+                durations, vals = self.duration_array(samples, capture_sample_duration(sample, self.sample_duration))
+            if self.max_samples:
+                self.full_sizes[key] = (len(values), len(durations))
+                values, deltas = self.subsample([values, deltas], sample, desc, 0)
+                durations, vals = self.subsample([durations, vals], sample, desc, 1)
+            self.arrays[key] = (values, deltas, durations, vals)
+        return self.arrays[key]
+
+    def norm_arrays(self, norm_sample, norm_desc):
+        """return (values, deltas, durations) of a norm sample on norm_desc
+        """
+        return self.sample_arrays(norm_sample, norm_desc)[:3]
+
+    def prepare_tests(self):
+        """run the Anderson-Darling tests of every descriptor in one batch before the
+        descriptors are compared; reject_null_hypothesis then reads the p-values of
+        these array pairs, and tests anything else one call at a time. Only the pairs
+        cmp_to_norm_sample tests are batched: none for an empty sample, which takes the
+        default similarity, no values of a key that is not meaningful, and no pair with
+        an empty array, which reject_null_hypothesis decides without a test.
+        """
+        pairs = []
+        for desc_key in self.schemas:
+            bug_desc = self.bug_schemas[desc_key]
+            key_type, key = self.key_description(bug_desc)
+            bug_values, bug_deltas, bug_durations, _ = self.sample_arrays(self.cur_bug_sample, bug_desc)
+            if len(self.cur_bug_sample.unfold_samples_for_desc(bug_desc)) == 0:
+                continue
+            for norm_sample in self.norms:
+                if self.cached_comparison(norm_sample, desc_key):
+                    continue
+                norm_values, norm_deltas, norm_durations = self.norm_arrays(norm_sample, self.norm_schemas[desc_key])
+                if len(norm_values) == 0:
+                    continue
+                if key_type == 'DW_TAG_base_type':
+                    if self.meaningful(key.symbol, key.type):
+                        pairs.append((norm_values, bug_values))
+                    pairs.append((norm_deltas, bug_deltas))
+                pairs.append((norm_durations, bug_durations))
+        tests = []
+        for norm, bug in pairs:
+            if norm.size == 0 or bug.size == 0:
+                continue
+            key = self.stats_key('anderson', scipy.__version__, norm, bug)
+            result = self.stats_cache.get(key)
+            if result is missing:
+                tests.append((key, norm, bug))
+            else:
+                self.pvalues[(id(norm), id(bug))] = result
+        results = anderson_2samp_batch([(norm, bug) for _, norm, bug in tests])
+        for (key, norm, bug), result in zip(tests, results):
+            self.stats_cache.put(key, result)
+            self.pvalues[(id(norm), id(bug))] = result
+
+    def array_digest(self, array):
+        """content hash of an array, computed once per array object
+        """
+        entry = self.digests.get(id(array))
+        if entry is None or entry[0] is not array:
+            entry = (array, array_digest(array))
+            self.digests[id(array)] = entry
+        return entry[1]
+
+    def stats_key(self, kind, params, norm, bug):
+        return self.stats_cache.key(kind, params, self.array_digest(norm), self.array_digest(bug))
+
+    def memoized(self, kind, params, norm, bug, compute):
+        """result of compute() on (norm, bug), from the stats cache when the same
+        statistic already ran on arrays of the same content
+        """
+        key = self.stats_key(kind, params, norm, bug)
+        result = self.stats_cache.get(key)
+        if result is missing:
+            result = compute()
+            self.stats_cache.put(key, result)
+        return result
+
+    def similar(self, norm, bug, bins=None):
         """Calculate the similarity on value range for a individual variable
         """
-        diff_rate, outliers = self.range_distance(norm, bug)
+        diff_rate, outliers = self.memoized('range', self.threshold, norm, bug, lambda: self.range_distance(norm, bug))
         if self.reject_null_hypothesis(norm, bug) == False:
             discount = self.default_discount
         else: #reject null, calculate a minimum discount with hellinger_distance
-            discount = 1.0 - self.hellinger_distance(norm, bug)
+            discount = 1.0 - self.memoized('hellinger', bins, norm, bug, lambda: self.hellinger_distance(norm, bug, bins))
         return discount, outliers
 
     def default_similarity(self, dimension, norm_array, bug_array):
+        """norm_array may be any array of the norm sample, only its emptiness matters
+        """
         discount = self.default_discount
-        outlier = []
+        outlier = np.array([])
         if len(norm_array) == 0 and len(bug_array) == 0:
             #if no value for both variables, we assume their values are similar
             picked_dimension = dimension + str(self.default_discount) + ': default(both=0)'
         elif len(norm_array) == 0:
             discount = self.validate_discount
-            outlier = list(set(self.value_array(bug_array)))
+            outlier = np.unique(self.value_array(bug_array))
             picked_dimension = dimension + '0.0 : zero(norm=0)'
         elif len(bug_array) == 0: #unlikely, in case comparine two versions where the variable is non-exist in the bug version.
             picked_dimension = dimension + str(self.default_discount) + ': default(bug=0)'
         return discount, outlier, picked_dimension
 
-    def value_similarity(self, key, dimension, norm_values, bug_values):
-        outlier = []
+    def value_similarity(self, key, dimension, norm_values, bug_values, norm_deltas, bug_deltas):
+        outlier = np.array([])
         picked_dimension = None
         if self.meaningful(key.symbol, key.type):
             discount, outlier_val = self.similar(norm_values, bug_values)
             outlier = outlier_val
             picked_dimension = dimension + str(discount) + ': val'
         #Calculate the similarity on the value deltas
-        delta_discount, outlier_delta = self.similar(self.delta_array(norm_values), self.delta_array(bug_values))
+        delta_discount, outlier_delta = self.similar(norm_deltas, bug_deltas)
         if picked_dimension == None or delta_discount <= discount:
             discount = delta_discount
-            outlier = []
-            prev_val = bug_values[0]
-            for i, val in enumerate(bug_values):
-                if val - prev_val in outlier_delta:
-                    outlier.append(val)
-                prev_val = val
+            #bug_deltas[i] is bug_values[i] minus the value before it, also after subsampling
+            outlier = bug_values[np.isin(bug_deltas, outlier_delta)]
             picked_dimension = dimension + str(discount) + ': delta'
         return discount, outlier, picked_dimension
 
     def processing_similarity(self, key, dimension, norm_duration, bug_duration, bug_vals):
         """Calculate the similarity on the processing time cost for individual value
         """
-        discount, duration_outliers = self.similar(norm_duration, bug_duration)
-        outliers = []
-        for i, processing in enumerate(bug_duration):
-            if processing in duration_outliers:
-                outliers.append(bug_vals[i]) 
+        discount, duration_outliers = self.similar(norm_duration, bug_duration, self.duration_bins)
+        outliers = bug_vals[np.isin(bug_duration, duration_outliers)]
         return discount, outliers, dimension + str(discount) + ': processing'
 
-    def cmp_to_norm_samples_on_desc(self, desc_key):
-        def prepare_arrays(key_type, bug_array):
-            bug_values = self.value_array(bug_array) if key_type == 'DW_TAG_base_type' else None
-            bug_processing, bug_vals = self.duration_array(bug_array)
-            return bug_values, bug_processing, bug_vals
+    def cmp_to_norm_sample(self, desc_key, norm_sample):
+        """compare the bug sample to one norm sample on a descriptor
+        """
         bug_desc = self.bug_schemas[desc_key]
         key_type, key = self.key_description(bug_desc)
         bug_array = self.cur_bug_sample.unfold_samples_for_desc(bug_desc)
-        bug_values, bug_processing, bug_vals = prepare_arrays(key_type, bug_array)
+        bug_values, bug_deltas, bug_processing, bug_vals = self.sample_arrays(self.cur_bug_sample, bug_desc)
 
-        non_fault_ratios = []
-        ratios = []
-        outliers = []
-        aggregated_dimension = []
-
-        for norm_sample in self.norms:
-            dimension = norm_sample.datafile + ' '
-            discount = self.default_discount
-            outlier = []
-            picked_dimension = None
-            
-            norm_desc = self.norm_schemas[desc_key]
-            norm_array = norm_sample.unfold_samples_for_desc(norm_desc)
-            if len(norm_array) == 0 or len(bug_array) == 0:
-                discount, outlier, picked_dimension = self.default_similarity(dimension, norm_array, bug_array)
-            else:
-                # value related similarity
-                if key_type == 'DW_TAG_base_type':
-                    norm_values = self.value_array(norm_array)
-                    discount, outlier, picked_dimension = self.value_similarity(key, dimension, norm_values, bug_values)
-                # processing simiarity
-                norm_processing, norm_vals = self.duration_array(norm_array)
-                duration_discount, duration_outlier, duration_dimension = self.processing_similarity(key, dimension, norm_processing, bug_processing, bug_vals)
-                if picked_dimension == None or duration_discount <= discount:
-                    discount = duration_discount
-                    outlier = duration_outlier
-                    picked_dimension = duration_dimension
-
-                discount = 0.0 if discount < self.validate_discount else discount
-                non_fault_ratios.append(discount)
+        dimension = norm_sample.datafile + ' '
+        discount = self.default_discount
+        outlier = np.array([])
+        picked_dimension = None
 
-            ratios.append(discount)
-            outliers.append(outlier)
-            aggregated_dimension.append(picked_dimension)
+        norm_desc = self.norm_schemas[desc_key]
+        norm_values, norm_deltas, norm_processing = self.norm_arrays(norm_sample, norm_desc)
+        weight = self.full_sizes.get((id(norm_sample), norm_desc), (len(norm_values),))[0]
+        if len(norm_values) == 0 or len(bug_array) == 0:
+            discount, outlier, picked_dimension = self.default_similarity(dimension, norm_values, bug_array)
+            return NormComparison(discount, outlier, picked_dimension, False, weight)
+        # value related similarity
+        if key_type == 'DW_TAG_base_type':
+            discount, outlier, picked_dimension = self.value_similarity(key, dimension, norm_values, bug_values, norm_deltas, bug_deltas)
+        # processing simiarity
+        duration_discount, duration_outlier, duration_dimension = self.processing_similarity(key, dimension, norm_processing, bug_processing, bug_vals)
+        if picked_dimension == None or duration_discount <= discount:
+            discount = duration_discount
+            outlier = duration_outlier
+            picked_dimension = duration_dimension
+
+        discount = 0.0 if discount < self.validate_discount else discount
+        return NormComparison(discount, outlier, picked_dimension, True, weight)
 
-        return ratios, non_fault_ratios, outliers, aggregated_dimension
+    def cmp_to_norm_samples_on_desc(self, desc_key):
+        """compare the bug sample to every norm sample on a descriptor, reusing the
+        comparisons loaded from the norm cache
+        """
+        comparisons = []
+        for norm_sample in self.norms:
+            comparison = self.norm_results.get(id(norm_sample), {}).get(desc_key)
+            if comparison is None:
+                comparison = self.cmp_to_norm_sample(desc_key, norm_sample)
+            comparisons.append(comparison)
+        return comparisons
+
+    def aggregate_ratios(self, comparisons):
+        """discount of a descriptor over its comparisons to the norm samples: the median
+        of the discounts, or with the pooled aggregation their mean weighted by the
+        number of samples of each norm. Comparisons of two non-empty samples are
+        preferred over the default ones.
+        """
+        if len(comparisons) == 0: #unlikely
+            return self.default_discount
+        picked = [comparison for comparison in comparisons if comparison.non_fault] or comparisons
+        total_weight = sum(comparison.weight for comparison in picked)
+        if self.aggregate == 'pooled' and total_weight > 0:
+            return sum(comparison.discount * comparison.weight for comparison in picked) / total_weight
+        return statistics.median([comparison.discount for comparison in picked])
 
     def var_discount_exp(self, desc_key):
         desc = self.bug_schemas[desc_key]
-        ratios, non_fault_ratios, outliers, aggregated_dimension = self.cmp_to_norm_samples_on_desc(desc_key)
-
-        if len(ratios) == 0: #unlikely
-            discount = self.default_discount
-        elif len(non_fault_ratios) > 0:
-            discount = statistics.median(non_fault_ratios)
-        else:
-            discount = statistics.median(ratios)
+        comparisons = self.cmp_to_norm_samples_on_desc(desc_key)
+        ratios = [comparison.discount for comparison in comparisons]
+        outliers = [comparison.outlier for comparison in comparisons]
+        aggregated_dimension = [comparison.dimension for comparison in comparisons]
+        non_fault_ratios = [comparison.discount for comparison in comparisons if comparison.non_fault]
+        discount = self.aggregate_ratios(comparisons)
 
         ret = re.search(regx_desc, desc)
         try:
@@ -308,12 +533,12 @@ class VarDiscountCalculator():
             fields.append(discount)
             fields.append(len(non_fault_ratios) == 0)
             if fields[func_index] == '#global':
-                self.global_vars.append(desc)
                 fields[func_index] = fields[symbol_index]+ '#global'
             discount_item = discount_entry(*fields)
         except Exception as ex:
             print(f'Error in parsing discount for {desc}: \n\t\t{fields} \n\t\tException = {ex}')
-        return [ratios, outliers, aggregated_dimension, discount_item]
+        note = self.subsample_note(desc_key) if self.max_samples else ''
+        return [ratios, outliers, aggregated_dimension, discount_item, note, comparisons]
 
     def infer_pattern(self, tag, dimension, discount):
         if re.search('processing', dimension):
@@ -328,6 +553,193 @@ class VarDiscountCalculator():
             return 'Scalability'
         return 'Undefined'
 
+    def set_approximate(self, max_samples, seed=0):
+        """cap every compared array at max_samples through seeded stratified
+        subsampling, over time for full samples and over sorted values for summaries;
+        None compares the full arrays
+        """
+        self.max_samples = max_samples
+        self.seed = seed
+
+    def subsample(self, arrays, sample, desc, kind):
+        """subsample arrays of equal length with the same indexes, so that values stay
+        aligned with their deltas and durations with their values. The arrays of a
+        VarSampleSummary are expanded histograms, each sorted by value on its own: the
+        strata are then quantiles rather than periods of time, and the subsampled
+        values, deltas and durations are not aligned with each other.
+        """
+        size = len(arrays[0])
+        if not self.max_samples or size <= self.max_samples:
+            return arrays
+        seed = [self.seed, zlib.crc32(desc.encode()), zlib.crc32(sample.datafile.encode()), kind]
+        indexes = stratified_indexes(size, self.max_samples, seed)
+        #summaries carry no vals, leave arrays that are not of the subsampled length alone
+        return [array if len(array) != size else
+            array[indexes] if isinstance(array, np.ndarray) else [array[i] for i in indexes.tolist()]
+            for array in arrays]
+
+    def subsample_note(self, desc_key):
+        """describe the subsampled arrays of a descriptor and the confidence lost, as the
+        widening of the KS critical distance between the full and the subsampled sizes
+        """
+        notes = []
+        bug_sizes = self.full_sizes.get((id(self.cur_bug_sample), self.bug_schemas[desc_key]))
+        for norm_sample in self.norms:
+            norm_sizes = self.full_sizes.get((id(norm_sample), self.norm_schemas[desc_key]))
+            if bug_sizes is None or norm_sizes is None:
+                continue
+            for kind, name in enumerate(['values', 'durations']):
+                n, m = bug_sizes[kind], norm_sizes[kind]
+                n_sub, m_sub = min(n, self.max_samples), min(m, self.max_samples)
+                if (n_sub, m_sub) == (n, m) or n == 0 or m == 0:
+                    continue
+                full = ks_critical_distance(n, m)
+                sub = ks_critical_distance(n_sub, m_sub)
+                notes.append(f'{name} bug {n}->{n_sub} norm {m}->{m_sub}, '
+                    f'KS critical distance {full:.4f}->{sub:.4f} (+{100 * (sub - full) / full:.0f}%)'
+                    + (', norm quantile sampled from its summary' if isinstance(norm_sample, VarSampleSummary) and m_sub < m else ''))
+        return '; '.join(notes)
+
+    def set_stats(self, stats):
+        """'batched' tests all descriptors in one pass of batched_stats,
+        'scipy' calls anderson_ksamp for every comparison
+        """
+        self.stats = stats
+
+    def set_norm_comparison(self, compare='random', aggregate='median', cache_dir=None):
+        """'random' compares the bug sample to one norm sample drawn at random, 'all' to
+        every norm sample; the per-norm discounts are aggregated by their 'median' or
+        'pooled' by a weighted mean. With a cache_dir, the comparisons of every
+        (bug, norm) pair are kept on disk, so a later run only compares new norms.
+        """
+        if compare == 'all':
+            self.norms = list(self.all_norms)
+        self.aggregate = aggregate
+        self.norm_cache = cache_dir
+
+    def norm_cache_file(self, norm_sample):
+        """the comparisons depend on both captures and on every setting of the comparison
+        """
+        def identity(sample):
+            files = []
+            for path in [sample.datafile, getattr(sample, 'layout_file', None)]:
+                if path and os.path.isfile(path):
+                    stat = os.stat(path)
+                    files.append((os.path.realpath(path), stat.st_mtime_ns, stat.st_size))
+                else:
+                    files.append(path)
+            if getattr(sample, 'thread', None) is not None:
+                files.append(('thread', sample.thread))
+            return files
+        #every setting a comparison depends on; duration_bins None compares the distinct durations
+        settings = (NORM_CACHE_VERSION, self.threshold, self.pvalue, self.validate_discount, self.default_discount,
+            self.sample_duration, self.max_samples, self.seed if self.max_samples else None,
+            ('duration_bins', self.duration_bins), ('stats', self.stats, scipy.__version__))
+        key = repr((identity(self.cur_bug_sample), identity(norm_sample), settings))
+        digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+        return os.path.join(self.norm_cache, f'norm_cmp.{digest}.pkl')
+
+    def load_norm_results(self):
+        """comparisons of the bug sample to the norm samples cached by earlier runs
+        """
+        self.norm_results = {}
+        if not self.norm_cache:
+            return
+        for norm_sample in self.norms:
+            cache_file = self.norm_cache_file(norm_sample)
+            try:
+                with open(cache_file, 'rb') as f:
+                    results = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                continue
+            self.norm_results[id(norm_sample)] = {desc_key: NormComparison(*result) for desc_key, result in results.items()}
+
+    def save_norm_results(self, computed):
+        """write the comparisons to the norm samples of computed to the cache
+        """
+        if not self.norm_cache:
+            return
+        os.makedirs(self.norm_cache, exist_ok=True)
+        for norm_sample in computed:
+            cache_file = self.norm_cache_file(norm_sample)
+            results = {desc_key: tuple(comparison) for desc_key, comparison in self.norm_results[id(norm_sample)].items()}
+            tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+
+    def cached_comparison(self, norm_sample, desc_key):
+        return desc_key in self.norm_results.get(id(norm_sample), {})
+
+    def set_stats_cache(self, capacity=4096, directory=None):
+        """keep the results of the statistics of the last capacity array pairs in
+        memory, and every result in directory when one is given
+        """
+        self.stats_cache = StatsCache(capacity, directory)
+
+    def set_duration_bins(self, bins):
+        """compare the processing durations over bins equal-width bins in the Hellinger
+        distance instead of over every distinct duration; None keeps the distinct values
+        """
+        self.duration_bins = bins
+
+    def set_engine(self, engine, workers=None):
+        """'thread' runs the descriptors on a thread pool, 'process' on a pool of
+        forked workers with at most workers processes
+        """
+        self.engine = engine
+        self.workers = workers
+
+    def desc_cost(self, desc_key):
+        """number of samples compared for the descriptor, to schedule large ones first
+        """
+        cost = len(self.cur_bug_sample.unfold_samples_for_desc(self.bug_schemas[desc_key]))
+        for norm_sample in self.norms:
+            if self.cached_comparison(norm_sample, desc_key):
+                continue
+            norm_desc = self.norm_schemas[desc_key]
+            if isinstance(norm_sample, VarSampleSummary):
+                summary = norm_sample.summaries.get(norm_desc)
+                cost += summary.count if summary else 0
+            else:
+                cost += len(norm_sample.unfold_samples_for_desc(norm_desc))
+        return cost
+
+    def desc_batches(self, nworkers):
+        """group the descriptors into batches of similar cost, largest first;
+        a large descriptor gets a batch of its own
+        """
+        costs = {desc_key: self.desc_cost(desc_key) for desc_key in self.schemas}
+        ordered = sorted(self.schemas, key=lambda desc_key: -costs[desc_key])
+        target = max(sum(costs.values()) / (nworkers * batches_per_worker), 1)
+        batches = []
+        batch_cost = target
+        for desc_key in ordered:
+            if batch_cost >= target:
+                batches.append([])
+                batch_cost = 0
+            batches[-1].append(desc_key)
+            batch_cost += costs[desc_key]
+        return batches
+
+    def var_discount_exp_processes(self):
+        """run var_discount_exp over forked workers. The samples are unfolded before
+        the fork, so workers share them copy-on-write instead of receiving copies;
+        the results are returned in schema order regardless of completion order
+        """
+        global engine_calculator
+        nworkers = self.workers or cpu_count()
+        batches = self.desc_batches(nworkers)
+        engine_calculator = self
+        results = {}
+        try:
+            with get_context('fork').Pool(min(nworkers, max(len(batches), 1))) as pool:
+                for batch_results in pool.imap_unordered(var_discount_batch, batches):
+                    results.update(batch_results)
+        finally:
+            engine_calculator = None
+        return [results[desc_key] for desc_key in self.schemas]
+
     def aggregate_discount_for_varsample(self, var_sample):
         """Aggregate discounts from variables to function
         select the minimal discount if multiple variables
@@ -337,20 +749,36 @@ class VarDiscountCalculator():
         save all possible anomaly
         """
         self.cur_bug_sample = var_sample
+        self.load_norm_results()
+        if self.stats == 'batched':
+            self.prepare_tests()
 
-        with ThreadPoolExecutor() as exe:
-            results = exe.map(self.var_discount_exp, self.schemas)
+        if self.engine == 'process':
+            results = self.var_discount_exp_processes()
+        else:
+            with ThreadPoolExecutor() as exe:
+                results = exe.map(self.var_discount_exp, self.schemas)
         #for schema_key in self.schemas:
         #    result = self.var_discount_exp(schema_key)
 
+        computed = {} #id -> norm samples compared in this run
         for schema_key, result in zip(self.schemas, results):
-            ratios, outliers, aggregated_dimension, discount_item = result
+            ratios, outliers, aggregated_dimension, discount_item, note, comparisons = result
+            for norm_sample, comparison in zip(self.norms, comparisons):
+                if not self.cached_comparison(norm_sample, schema_key):
+                    computed[id(norm_sample)] = norm_sample
+                    self.norm_results.setdefault(id(norm_sample), {})[schema_key] = comparison
             desc = self.bug_schemas[schema_key]
+            if note:
+                self.subsample_notes[desc] = note
+            if discount_item.function == discount_item.symbol + '#global':
+                self.global_vars.append(desc)
             self.discount_on_var[desc] = discount_item
             self.desc_to_func[desc] = self.discount_on_var[desc].function
             self.desc_to_dimension[desc] = aggregated_dimension
             var_sample.discounts_dict[desc] = ratios
             var_sample.outliers_dict[desc] = outliers
+        self.save_norm_results(computed.values())
 
         for desc, func in self.desc_to_func.items():
             dimension = ','.join(self.desc_to_dimension[desc])
@@ -396,6 +824,12 @@ class VarDiscountCalculator():
                     function_cost[function] = func_samples[function]
         return function_cost
 
+#calculator of the running process engine, inherited by the forked workers
+engine_calculator = None
+
+def var_discount_batch(desc_keys):
+    return [(desc_key, engine_calculator.var_discount_exp(desc_key)) for desc_key in desc_keys]
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Attribute variable samples to corresponding functions')
     parser.add_argument('--norm_bin', required=True, help='')
@@ -3,6 +3,8 @@ import sys
 import glob
 import argparse
 import re
+import mmap
+import tempfile
 import pandas as pd
 import numpy as np
 from scipy.stats import spearmanr
@@ -30,38 +32,145 @@ HdrFormat='@PPii15sciiiiiiii'
 Var = namedtuple('Var', ['loc_atom', 'addr', 'size', 'link',
         'sample_tail', 'lower', 'upper'])
 VarFormat='@HllLLLL'
-Val = namedtuple('Val', ['seqid', 'type', 'val', 'tid', 'var_pc', 'callee_pc', 'link'])
+Val = namedtuple('Val', ['seqid', 'type', 'val', 'tid', 'pc', 'callee_pc', 'link'])
 ValFormat='@QHQQLLL'
+CallsiteFormat='@L'
+
+def sampling_period(prof_rate):
+    """seconds between two samples of a profiler running at prof_rate Hz, None if unknown
+    """
+    if prof_rate and prof_rate > 0:
+        return 1.0 / prof_rate
+    return None
+
+def struct_dtype(names, fmt, itemsize=None):
+    """numpy structured dtype with the same field offsets and padding as the native struct format
+    """
+    codes = re.findall(r'(\d*)([a-zA-Z?])', fmt[1:])
+    formats = []
+    offsets = []
+    prefix = fmt[0]
+    for count, code in codes:
+        #a zero repeat count aligns the offset without consuming data
+        offsets.append(struct.calcsize(prefix + '0' + code))
+        if code in 'sc':
+            formats.append('S' + (count or '1'))
+        else:
+            formats.append(np.dtype('=' + code))
+        prefix = prefix + count + code
+    return np.dtype({'names': list(names), 'formats': formats, 'offsets': offsets,
+        'itemsize': itemsize or struct.calcsize(fmt)})
+
+HdrDtype = struct_dtype(Hdr._fields, HdrFormat)
+VarDtype = struct_dtype(Var._fields, VarFormat)
+ValDtype = struct_dtype(Val._fields, ValFormat)
+#arrays a worker hands back to the parent; with a spill_dir the large ones travel as .npy files
+SampleColumns = ['callsites', 'variables', 'samples', 'pc_addresses', 'pc_line_numbers', 'pc_file_ids',
+        'sample_ids', 'sample_offsets']
+SpilledArray = namedtuple('SpilledArray', ['path', 'recarray'])
+spill_threshold = 1 << 20 #bytes
+#samples unfolded for a descriptor carry the translated source location
+SampleDtype = np.dtype([(name, ValDtype.fields[name][0]) for name in Val._fields] +
+        [('line', object), ('file', object), ('function', object)])
+
+class SampleChain:
+    """samples of one variable, following sample_tail and link on every iteration
+    instead of keeping the list of sample indexes. Only the walk is lazy: unfolding
+    the variable still builds its index array and record copy, see
+    VarSample.unfold_samples_for_desc.
+    """
+    def __init__(self, links, tail):
+        self.links = links
+        self.tail = tail
+
+    def __iter__(self):
+        """sample indexes from the tail back to the head of the chain
+        """
+        sample_index = self.tail
+        prev_index = 0
+        while sample_index != prev_index and sample_index > 0:
+            yield sample_index
+            prev_index = sample_index
+            try:
+                sample_index = int(self.links[prev_index])
+            except Exception as ex:
+                print(f'Fail to get sample[{prev_index}].link')
+                print(ex)
 
-class ValueEntry:
-    def __init__(self, value, _line, _file):
-        self.seqid = value.seqid
-        self.type = value.type
-        self.val = value.val
-        self.tid = value.tid
-        self.pc = value.var_pc
-        self.callee_pc = value.callee_pc
-        self.link = value.link
-        self.line = _line
-        self.file = _file
-        self.function = None
-        self.propagate = set()
+    def indexes(self):
+        """the chain as an array in sample order, the order of the sample index
+        """
+        return np.fromiter(self, dtype=np.int64)[::-1]
 
 class VarSample:
-    def __init__(self, schema_items, filename):
+    def __init__(self, schema_items, filename, use_mmap=False):
+        self.use_mmap = use_mmap
         self.load_address = 0
         self.schema_items = schema_items
         self.datafile = filename
+        self.prof_rate = 0 #samples per second, from the header
         self.schema_descs = {}
-        self.callsites = []
-        self.variables = []
-        self.samples = []
+        self.callsites = np.zeros(0, dtype=np.dtype(CallsiteFormat[1:]))
+        self.variables = np.zeros(0, dtype=VarDtype).view(np.recarray)
+        self.samples = np.zeros(0, dtype=ValDtype).view(np.recarray)
+        self.pc_addresses = np.zeros(0, dtype=np.uint64)
+        self.pc_line_numbers = np.zeros(0, dtype=np.int64)
+        self.pc_file_ids = np.zeros(0, dtype=np.int32)
+        self.file_names = []
+        self.pc_lines = np.zeros(0, dtype=object)
+        self.pc_files = np.zeros(0, dtype=object)
+        self.spill_dir = None
         self.sample_dict = {}
+        self.sample_ids = np.zeros(0, dtype=np.int64)
+        self.sample_offsets = np.zeros(1, dtype=np.int64)
+        self.unfolded_samples = {} #sorted, deduplicated samples per desc, filled on first access
+        self.thread_tids = None #tids in order of their first sample, filled on first access
+        self.thread_groups = {} #desc -> unfolded samples grouped by thread class and their offsets
         self.discounts_dict = {} #store discount list for key, compared to a list of normal samples
         self.outliers_dict = {} #store abnormal value list for key, compared to a list of normal samples
         self.unpack_raw()
         self.classify_samples()
     
+    def __getstate__(self):
+        """pickle the sample as flat arrays: the object arrays of source locations, the
+        per-variable views and the unfolded records are rebuilt by the receiver.
+        With spill_dir set, arrays above spill_threshold are written to .npy files
+        and only their paths are pickled.
+        """
+        state = dict(self.__dict__)
+        for name in ['pc_lines', 'pc_files', 'sample_dict', 'unfolded_samples', 'thread_groups']:
+            state.pop(name, None)
+        if self.spill_dir:
+            for name in SampleColumns:
+                array = state[name]
+                if array.nbytes < spill_threshold:
+                    continue
+                #a fresh file per array: a path derived from id(self) may be reused by the next
+                #sample before the parent has loaded and removed the previous one
+                fd, path = tempfile.mkstemp(prefix=f'{name}.', suffix='.npy', dir=self.spill_dir)
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, np.asarray(array), allow_pickle=False)
+                state[name] = SpilledArray(path, isinstance(array, np.recarray))
+        return state
+
+    def __setstate__(self, state):
+        """spilled arrays are mapped copy-on-write and their files removed right away;
+        the mapping keeps the data alive
+        """
+        for name in SampleColumns:
+            spilled = state[name]
+            if isinstance(spilled, SpilledArray):
+                array = np.load(spilled.path, mmap_mode='c', allow_pickle=False)
+                os.remove(spilled.path)
+                state[name] = array.view(np.recarray) if spilled.recarray else array
+        self.__dict__.update(state)
+        self.spill_dir = None
+        self.unfolded_samples = {}
+        self.thread_groups = {}
+        self.locate_pcs()
+        self.sample_dict = {}
+        self.group_samples()
+
     def print_info(self):
         print(self.datafile)
         print(self.hdr)
@@ -73,62 +182,83 @@ class VarSample:
         print(f'#samples = {self.samples[0].link}')
         print(len(self.samples))
 
-    def unpack_raw(self):
-        """restoring variable samples from the binary data file
+    def read_raw(self):
+        """return a writable buffer over the data file. With use_mmap the file is mapped
+        copy-on-write, so arrays decoded from it are views of the page cache and only pages
+        touched by the load address correction get private copies.
         """
         with open(self.datafile, 'rb') as f:
-            data = f.read()
-            hdr_size = struct.calcsize(HdrFormat)
-            callsite_size = struct.calcsize('@L')
-            hdr = Hdr._make(struct.unpack(HdrFormat, data[0 : hdr_size]))
-            callsites_offset = hdr_size
-            varoffset = hdr_size + hdr.froms_size
-            sampleoffset = varoffset + hdr.var_limit * hdr.var_size
-            self.hdr = hdr
-
-            for i in range(callsites_offset, varoffset, callsite_size):
-                callsite,  = struct.unpack('@L', data[i: i + callsite_size])
-                self.callsites.append(callsite)
-
-            for i in range(varoffset, sampleoffset, hdr.var_size):
-                var = Var._make(struct.unpack(VarFormat, data[i: i + hdr.var_size]))
-                self.variables.append(var)
-
-            for i in range(sampleoffset, len(data), hdr.sample_size):
-                try:
-                    val = Val._make(struct.unpack(ValFormat, data[i: i + hdr.sample_size]))
-                    sample = ValueEntry(val, None, None)
-                    self.samples.append(sample)
-                except Exception as ex:
-                    pass
-            #for old data, which does not substract load address for unwinded pc, use self.load_address to adjust
-            #otherwise, self.load_address will be always 0
-                if self.load_address == 0 and sample.type == 1:
-                    self.load_address = sample.pc - sample.callee_pc
-            if self.load_address > 0:
-                for sample in self.samples:
-                    sample.pc = sample.pc - self.load_address - 6
+            if self.use_mmap:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            data = bytearray(os.fstat(f.fileno()).st_size)
+            f.readinto(data)
+            return data
+
+    def unpack_raw(self):
+        """restoring variable samples from the binary data file;
+        callsites, variables and samples are decoded as numpy arrays over the file buffer
+        """
+        data = self.read_raw()
+        hdr_size = struct.calcsize(HdrFormat)
+        hdr = Hdr._make(np.frombuffer(data, dtype=HdrDtype, count=1)[0].tolist())
+        callsites_offset = hdr_size
+        varoffset = hdr_size + hdr.froms_size
+        sampleoffset = varoffset + hdr.var_limit * hdr.var_size
+        self.hdr = hdr
+        self.prof_rate = hdr.prof_rate
+
+        callsite_dtype = np.dtype(CallsiteFormat[1:])
+        self.callsites = np.frombuffer(data, dtype=callsite_dtype, count=hdr.froms_size // callsite_dtype.itemsize,
+                offset=callsites_offset)
+        self.variables = np.frombuffer(data, dtype=struct_dtype(Var._fields, VarFormat, hdr.var_size),
+                count=hdr.var_limit, offset=varoffset).view(np.recarray)
+
+        #samples[0].link counts the samples in use, the rest of the ring is empty
+        val_dtype = struct_dtype(Val._fields, ValFormat, hdr.sample_size)
+        nsamples = max(len(data) - sampleoffset, 0) // hdr.sample_size
+        if nsamples > 0:
+            used, = np.frombuffer(data, dtype=val_dtype, count=1, offset=sampleoffset)['link']
+            nsamples = min(nsamples, int(used) + 1)
+        self.samples = np.frombuffer(data, dtype=val_dtype, count=nsamples, offset=sampleoffset).view(np.recarray)
+
+        #for old data, which does not substract load address for unwinded pc, use self.load_address to adjust
+        #otherwise, self.load_address will be always 0
+        selfpc = self.samples.type == 1
+        offsets = self.samples.pc[selfpc].astype(np.int64) - self.samples.callee_pc[selfpc].astype(np.int64)
+        nonzero = np.flatnonzero(offsets)
+        if nonzero.size > 0:
+            self.load_address = int(offsets[nonzero[0]])
+        if self.load_address > 0:
+            #pcs below the load address resolve to no line, as the negative pcs of old did,
+            #rather than wrapping around to the top of the address space
+            adjust = np.uint64(self.load_address + 6)
+            below = self.samples.pc < adjust
+            np.subtract(self.samples.pc, adjust, out=self.samples.pc, where=~below)
+            self.samples.pc[below] = 0
 
     def translate_pc(self, layout):
-        def collect_addresses():
-            addresses = set()
-            for sample in self.samples:
-                addresses.add(sample.pc)
-            return addresses
-
-        def attach_line_info_to_sample(map_to_line, map_to_file):
-            for sample in self.samples:
-                var_addr = sample.pc
-                if var_addr in map_to_line:
-                    sample.line = map_to_line[var_addr]
-                    sample.file = map_to_file[var_addr]
-                else:
-                    sample.line = "LineNotFound"
-                    sample.file = "FileNotFound"
-
-        addresses = list(collect_addresses())
-        map_to_line, map_to_file = layout.decode_files_lines(addresses)
-        attach_line_info_to_sample(map_to_line, map_to_file)
+        """resolve the file and line of every distinct pc once;
+        samples look up their location when they are gathered
+        """
+        addresses = np.unique(self.samples.pc)
+        if len(layout.lookup) == 0:
+            print('Address map(line prog) is not initialized')
+        lines, file_ids = layout.lookup.resolve(addresses)
+        self.pc_addresses = addresses
+        self.pc_line_numbers = lines
+        self.pc_file_ids = file_ids
+        self.file_names = list(layout.lookup.file_names)
+        self.locate_pcs()
+        self.invalidate_unfolded_samples()
+
+    def locate_pcs(self):
+        """expand the line numbers and file ids of the distinct pcs into the
+        object arrays copied into unfolded samples
+        """
+        file_names = np.array(self.file_names + ["FileNotFound"], dtype=object)
+        self.pc_lines = self.pc_line_numbers.astype(object)
+        self.pc_lines[self.pc_line_numbers < 0] = "LineNotFound"
+        self.pc_files = file_names[self.pc_file_ids]
 
     def attach_function_to_globals(self, sample_array):
         def construct_line_to_function():
@@ -168,27 +298,57 @@ class VarSample:
     def attach_value_flow(self, desc, sample, layout):
         return layout.attach_value_flow(desc, sample)
         
+    def build_sample_index(self):
+        """label every sample with the variable owning its chain and group the samples
+        per variable in one pass: sample_ids[sample_offsets[v]:sample_offsets[v + 1]]
+        are the samples of variable v sorted by seqid.
+        A sample's successor is the sample linking to it; pointer jumping over the
+        successors finds the chain tail, which is the sample_tail of the owner.
+        Links must point to earlier samples, as the profiler allocates them in order.
+        """
+        nsamples = len(self.samples)
+        index_dtype = np.int32 if nsamples < np.iinfo(np.int32).max else np.int64
+        sample_range = np.arange(nsamples, dtype=index_dtype)
+        links = self.samples.link
+        linked = np.flatnonzero((links > 0) & (links < sample_range))
+        tails = sample_range.copy()
+        tails[links[linked].astype(index_dtype)] = linked
+        while True:
+            jumped = tails[tails]
+            if np.array_equal(jumped, tails):
+                break
+            tails = jumped
+
+        owners = np.full(nsamples, -1, dtype=index_dtype)
+        var_tails = self.variables.sample_tail.astype(np.int64)
+        var_range = np.flatnonzero((var_tails > 0) & (var_tails < nsamples))
+        owners[var_tails[var_range]] = var_range
+        owners = owners[tails]
+
+        labeled = np.flatnonzero(owners >= 0).astype(index_dtype)
+        order = np.lexsort((labeled, self.samples.seqid[labeled], owners[labeled]))
+        self.sample_ids = labeled[order]
+        counts = np.bincount(owners[labeled], minlength=len(self.variables))
+        self.sample_offsets = np.zeros(counts.size + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.sample_offsets[1:])
+
+    def var_sample_ids(self, var_index):
+        return self.sample_ids[self.sample_offsets[var_index]:self.sample_offsets[var_index + 1]]
+
     def extract_from_sample_array(self, metadata):
         """get a set of var_index(lines describe location atomic in config)
         and corresponding sample lists for each var_index
-        sorted as a dict
+        sorted as a dict; with use_mmap the lists are SampleChains walked on demand,
+        otherwise they are slices of the sample index
         """
         var_samples = {}
+        links = self.samples.link
         for val in set(entry['var_index'] for entry in metadata):
             var_index = int(val)
-            var_samples[var_index] = []
-            sample_index = self.variables[var_index].sample_tail
-            prev_index = 0
-            while sample_index != prev_index and sample_index > 0:
-                var_samples[var_index].append(sample_index)
-                prev_index = sample_index
-                try:
-                    next_index = self.samples[prev_index].link
-                    sample_index = next_index
-                except Exception as ex:
-                    print(f'Fail to get sample[{prev_index}].link')
-                    print(ex)
-            var_samples[var_index].sort()
+            if self.use_mmap:
+                var_samples[var_index] = SampleChain(links, int(self.variables.sample_tail[var_index]))
+            else:
+                var_samples[var_index] = self.var_sample_ids(var_index)
         return var_samples
 
     def classify_samples(self):
@@ -196,33 +356,103 @@ class VarSample:
         where var_samples maps var_index(one line describes location atomic in config)
         into a list of variale samples.
         """
+        if not self.use_mmap:
+            self.build_sample_index()
+        self.group_samples()
+
+    def group_samples(self):
         for desc in self.schema_items:
             self.sample_dict[desc[0][1]] = self.extract_from_sample_array(desc[1:])
             self.schema_descs[desc[0][0]] = desc[0][1]
 
     def unfold_samples_for_desc(self, desc):
-        """convert the var_samples dict into sample array sorted by timestamp
+        """convert the var_samples dict into a record array of samples sorted by timestamp,
+        keeping the first sample of each timestamp. The array is computed on first access
+        and shared by later callers until invalidate_unfolded_samples.
+        With use_mmap the records are copied out of the mapping all the same and kept
+        until invalidated, and a sample returned by a pool worker pickles its mapped
+        columns by value unless they are spilled: mapping bounds the memory of the raw
+        file in the worker, not of the unfolded descriptors or of the parent.
         """
-        samples_array = []
+        if desc in self.unfolded_samples:
+            return self.unfolded_samples[desc]
         if not desc in self.sample_dict:
-            return samples_array
+            return np.zeros(0, dtype=SampleDtype).view(np.recarray)
 
         s = self.sample_dict[desc]
-        for var_index, s_indexes in s.items():
-            for sample_index in s_indexes:
-                sample = self.samples[sample_index]
-                samples_array.append(sample)
-        samples_array.sort(key=lambda x:x.seqid)
-        dedup_array = []
-        prev = None
-        for sample in samples_array:
-            if prev == None:
-                dedup_array.append(sample)
-                prev = sample
-            elif sample.seqid != prev.seqid:
-                    dedup_array.append(sample)
-                    prev = sample
-        return dedup_array
+        indexes = np.concatenate([s_indexes.indexes() if isinstance(s_indexes, SampleChain) else np.fromiter(s_indexes, dtype=np.int64)
+                for s_indexes in s.values()] +
+                [np.zeros(0, dtype=np.int64)])
+        seqids = self.samples.seqid[indexes]
+        order = np.argsort(seqids, kind='stable')
+        indexes = indexes[order]
+        seqids = seqids[order]
+        first = np.ones(indexes.size, dtype=bool)
+        first[1:] = seqids[1:] != seqids[:-1]
+        self.unfolded_samples[desc] = self.sample_records(indexes[first])
+        return self.unfolded_samples[desc]
+
+    def threads(self):
+        """tids of the sampled threads in order of their first sample; the position of a
+        tid is its thread class, which matches the threads of different captures
+        """
+        if self.thread_tids is None:
+            if self.sample_ids.size > 0:
+                used = self.sample_ids
+            else:
+                #the chains are not indexed with use_mmap, take every recorded sample
+                used = self.samples.seqid > 0
+            #index the two columns only, a mapped capture is not copied
+            tids, inverse = np.unique(self.samples.tid[used], return_inverse=True)
+            first = np.full(tids.size, np.iinfo(np.uint64).max, dtype=np.uint64)
+            np.minimum.at(first, inverse, self.samples.seqid[used].astype(np.uint64))
+            self.thread_tids = tids[np.argsort(first, kind='stable')]
+        return self.thread_tids
+
+    def thread_view(self, thread):
+        return ThreadSample(self, thread)
+
+    def thread_records(self, desc):
+        """the unfolded samples of desc grouped by thread class in one pass: the samples
+        of class k are records[offsets[k]:offsets[k + 1]], still sorted by timestamp
+        """
+        if desc not in self.thread_groups:
+            tids = self.threads()
+            records = self.unfold_samples_for_desc(desc)
+            order = np.argsort(tids, kind='stable')
+            classes = order[np.searchsorted(tids, records.tid, sorter=order)] if records.size > 0 else np.zeros(0, dtype=np.int64)
+            offsets = np.zeros(tids.size + 1, dtype=np.int64)
+            np.cumsum(np.bincount(classes, minlength=tids.size), out=offsets[1:])
+            self.thread_groups[desc] = (records[np.argsort(classes, kind='stable')], offsets)
+        return self.thread_groups[desc]
+
+    def thread_counts(self, desc):
+        """number of samples of desc in every thread class
+        """
+        return np.diff(self.thread_records(desc)[1])
+
+    def invalidate_unfolded_samples(self, desc=None):
+        """drop the cached samples of desc, or of every desc if desc is None
+        """
+        if desc is None:
+            self.unfolded_samples.clear()
+            self.thread_groups.clear()
+        else:
+            self.unfolded_samples.pop(desc, None)
+            self.thread_groups.pop(desc, None)
+
+    def sample_records(self, indexes):
+        """gather samples with their source locations into a standalone record array
+        """
+        records = np.empty(len(indexes), dtype=SampleDtype).view(np.recarray)
+        raw = self.samples[indexes]
+        for name in Val._fields:
+            records[name] = raw[name]
+        if self.pc_addresses.size > 0:
+            pc_index = np.searchsorted(self.pc_addresses, records.pc)
+            records.line = self.pc_lines[pc_index]
+            records.file = self.pc_files[pc_index]
+        return records
 
     def print_sample(self, sample):
         text = '    timestamp = {s_id}, type = {stype}, val = 0x{val:x}, pc = 0x{pc:x}, tid = 0x{tid:x}, file = {filename}, line = {line}\n'
@@ -254,9 +484,36 @@ class VarSample:
                         f.write(f'    timestamp = {sample.seqid}, type = {sample.type}, val = 0x{sample.val:x}, pc = 0x{sample.pc:x}, tid = 0x{sample.tid:x}, file = {sample.file}, line = {sample.line}\n')
                     return
 
+class ThreadSample:
+    """the samples of one thread class of a VarSample, for the discount calculator.
+    Threads are numbered in order of their first sample, so that class k of a norm
+    capture is compared to class k of the bug capture. The view slices the unfolded
+    samples of its class out of the grouping of the capture and shares everything else
+    with it.
+    """
+    def __init__(self, sample, thread):
+        self.sample = sample
+        self.thread = thread
+        tids = sample.threads()
+        self.tid = int(tids[thread]) if thread < tids.size else None
+        self.discounts_dict = {}
+        self.outliers_dict = {}
+
+    def __getattr__(self, name):
+        if name == 'sample':
+            raise AttributeError(name)
+        return getattr(self.sample, name)
+
+    def unfold_samples_for_desc(self, desc):
+        records, offsets = self.sample.thread_records(desc)
+        if self.tid is None:
+            return records[:0]
+        return records[offsets[self.thread]:offsets[self.thread + 1]]
+
 class VarSamples:
-    def __init__(self, directory, binary, maxcount, srcinfo):
+    def __init__(self, directory, binary, maxcount, srcinfo, use_mmap=False):
         self.dir = directory
+        self.use_mmap = use_mmap
         self.bin = binary
         self.srcinfo = srcinfo
         self.max_count = maxcount
@@ -264,8 +521,18 @@ class VarSamples:
         self.collect_files()
         self.size = len(self.files_analyze)
         self.schemas = []
+        self.reducer = None
+        self.full_files = set()
+        self.spill_dir = None
         #self.parse()
 
+    def set_reducer(self, reducer, full_files=()):
+        """stream the files: workers pass each parsed VarSample to reducer and return
+        only its result, except for full_files, which are returned whole
+        """
+        self.reducer = reducer
+        self.full_files = set(full_files)
+
     def set_schemas(self):
         if len(self.samples) > 0:
             self.schemas = self.samples[0].schema_descs
@@ -274,15 +541,34 @@ class VarSamples:
         self.size = len(self.samples)
         return self.size
 
+    def layout_file(self, data_file):
+        return data_file.replace('gmon_var', 'layout')
+
+    def load_layout(self):
+        """decode the binary once in the parent; the address lookup is kept in the
+        static_analyzer registry, so forked workers inherit it and only parse the
+        schema metadata of their own layout file
+        """
+        if len(self.files_analyze) == 0 or not self.bin or not os.path.isfile(self.bin):
+            return
+        Layout(self.layout_file(self.files_analyze[0]), self.bin)
+
     def parse_var_file(self, data_file):
-        layout_file = data_file.replace('gmon_var', 'layout')
+        layout_file = self.layout_file(data_file)
         layout = Layout(layout_file, self.bin)
-        sample = VarSample(layout.get_schema_meta(), data_file)
+        sample = VarSample(layout.get_schema_meta(), data_file, self.use_mmap)
         sample.layout_file = layout_file
         sample.srcinfo = self.srcinfo
+        sample.spill_dir = self.spill_dir
         sample.translate_pc(layout)
         return sample
 
+    def load_var_file(self, data_file):
+        sample = self.parse_var_file(data_file)
+        if self.reducer is None or data_file in self.full_files:
+            return sample
+        return self.reducer(sample)
+
     def collect_files(self):
         files = []
         for datafile in glob.iglob(self.dir + '/**/gmon_var.*.out', recursive = True):
@@ -295,8 +581,9 @@ class VarSamples:
         self.files_analyze = files_analyze
 
     def parse(self):
+        self.load_layout()
         with Pool() as pool:
-            self.samples = pool.map(self.parse_var_file, self.files_analyze)
+            self.samples = pool.map(self.load_var_file, self.files_analyze)
         self.set_schemas()
         return self.samples
 
@@ -320,6 +607,9 @@ if __name__ == '__main__':
 
     norm_vars = VarSamples(args.norms, args.norm_bin, int(args.max), args.norm_srcinfo)
     bug_vars = VarSamples(args.bugs, args.bug_bin, int(args.max), args.bug_srcinfo)
+    #decode the binaries before forking so that workers share the address lookups
+    norm_vars.load_layout()
+    bug_vars.load_layout()
     with Pool() as pool:
         norm_results = pool.map_async(norm_vars.parse_var_file, norm_vars.files_analyze)
         bug_results = pool.map_async(bug_vars.parse_var_file, bug_vars.files_analyze)
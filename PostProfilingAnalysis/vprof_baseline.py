@@ -0,0 +1,76 @@
+import os
+import argparse
+import pickle
+import time
+
+from gmon_sample_multiprocessing import gmonSamples
+from static_analyzer import binary_id
+from var_sample_multiprocessing import VarSamples
+from var_discount_multiprocessing import VarSampleSummary
+
+#bump when the pickled layout of NormBaseline or VarSampleSummary changes
+BASELINE_VERSION = 1
+
+class NormBaseline:
+    """Norm captures reduced once to what the discount calculators read: the flat
+    profiles of the gmon files and per-variable summaries of the gmon_var files.
+    Stands in for the norm gmonSamples and VarSamples of a diagnosis.
+    """
+    def __init__(self, directory, binary, maxcount, srcinfo=None, use_mmap=False):
+        self.version = BASELINE_VERSION
+        self.dir = directory
+        self.bin = binary
+        self.binary_id = binary_id(binary) if os.path.isfile(binary) else None
+        self.created = time.time()
+        self.gmons = gmonSamples(directory, binary, maxcount)
+        var_samples = VarSamples(directory, binary, maxcount, srcinfo, use_mmap)
+        var_samples.set_reducer(VarSampleSummary)
+        var_samples.parse()
+        self.files_analyze = var_samples.files_analyze
+        self.samples = var_samples.samples
+        self.size = len(self.samples)
+        self.schemas = var_samples.schemas
+
+    def set_schemas(self):
+        if len(self.samples) > 0:
+            self.schemas = self.samples[0].schema_descs
+
+    def save(self, path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            #the state rather than the instance, so the file loads whether or not it was written by __main__
+            pickle.dump({'version': BASELINE_VERSION, 'state': self.__dict__}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+def load_baseline(path, binary=None):
+    """load a baseline saved by NormBaseline.save; warn when binary is not the
+    build the baseline was collected from
+    """
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    if not isinstance(data, dict) or data.get('version') != BASELINE_VERSION:
+        version = data.get('version') if isinstance(data, dict) else None
+        raise ValueError(f'{path}: baseline version {version}, expected {BASELINE_VERSION}; rebuild it')
+    baseline = NormBaseline.__new__(NormBaseline)
+    baseline.__dict__.update(data['state'])
+    if binary and os.path.isfile(binary) and baseline.binary_id and binary_id(binary) != baseline.binary_id:
+        print(f'warning: {binary} differs from {baseline.bin} the baseline {path} was built from')
+    return baseline
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reduce norm captures to a baseline reusable by vprof_profile.py --baseline')
+    parser.add_argument('--norm_bin', required=True, help='')
+    parser.add_argument('--norms', default = 'norms', help='')
+    parser.add_argument('--norm_srcinfo', default='norms/src2bb.txt')
+    parser.add_argument('--max', default = 8, help ='maximum number of samples supported to process')
+    parser.add_argument('--mmap', action='store_true', help='map gmon_var files instead of reading them into memory')
+    parser.add_argument('--output', default = 'norms.baseline')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    baseline = NormBaseline(args.norms, args.norm_bin, int(args.max), args.norm_srcinfo, args.mmap)
+    if baseline.size == 0 or baseline.gmons.size == 0:
+        print('var samples or gmon samples missing in norm case')
+        exit(1)
+    baseline.save(args.output)
+    print(f'--- {time.time() - start_time} seconds building baseline of {baseline.size} captures into {args.output} ---')
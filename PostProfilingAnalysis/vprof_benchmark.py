@@ -0,0 +1,462 @@
+import os
+import sys
+import argparse
+import copy
+import pickle
+import tempfile
+import time
+from collections import namedtuple
+from multiprocessing import Pool
+
+import numpy as np
+
+from var_sample_multiprocessing import VarSamples, SampleDtype, Var
+import var_discount_multiprocessing as kernels
+from cost_discount_multiprocessing import CostDiscountCalculator
+from gmon_sample_multiprocessing import gmonSamples, histEntry
+from gmon_reader import CallGraph
+
+def timed(func, *args, repeat=3):
+    """best wall time of repeat calls and the result of the last one
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def ipc_roundtrip(state):
+    data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.loads(data)
+    return len(data)
+
+class LegacyValueEntry:
+    """a sample as VarSample held it before the columnar layout, one object per sample
+    """
+    def __init__(self, record):
+        self.seqid = int(record.seqid)
+        self.type = int(record.type)
+        self.val = int(record.val)
+        self.tid = int(record.tid)
+        self.pc = int(record.pc)
+        self.callee_pc = int(record.callee_pc)
+        self.link = int(record.link)
+        self.line = record.line
+        self.file = record.file
+        self.function = None
+        self.propagate = set()
+
+def legacy_state(sample):
+    """what was pickled before samples had a columnar state: the instance dict of the
+    old VarSample, with lists of callsites, Var tuples and LegacyValueEntry objects,
+    and the sample indexes of every variable as lists
+    """
+    records = sample.sample_records(np.arange(len(sample.samples)))
+    return {
+        'load_address': sample.load_address,
+        'schema_items': sample.schema_items,
+        'datafile': sample.datafile,
+        'schema_descs': sample.schema_descs,
+        'hdr': sample.hdr,
+        'callsites': sample.callsites.tolist(),
+        'variables': [Var._make(variable) for variable in sample.variables.tolist()],
+        'samples': [LegacyValueEntry(record) for record in records],
+        'sample_dict': {desc: {var_index: sorted(int(index) for index in indexes) for var_index, indexes in var_samples.items()}
+            for desc, var_samples in sample.sample_dict.items()},
+        'discounts_dict': {},
+        'outliers_dict': {},
+    }
+
+def pool_parse(var_samples, spill_dir):
+    var_samples.spill_dir = spill_dir
+    with Pool() as pool:
+        return pool.map(var_samples.load_var_file, var_samples.files_analyze)
+
+def bench_ipc(args):
+    """bytes and time to send parsed gmon_var files from a worker to the parent
+    """
+    var_samples = VarSamples(args.dir, args.bin, int(args.max), None, args.mmap)
+    var_samples.load_layout()
+    print(f'{len(var_samples.files_analyze)} files in {args.dir}')
+    print(f'{"file":<32}{"mode":>10}{"bytes":>14}{"seconds":>10}')
+    totals = {}
+    with tempfile.TemporaryDirectory(prefix='vprof-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None) as spill_dir:
+        for data_file in var_samples.files_analyze:
+            sample = var_samples.parse_var_file(data_file)
+            modes = [('legacy', lambda: legacy_state(sample)), ('columnar', lambda: sample)]
+            for mode, state in modes:
+                sample.spill_dir = None
+                seconds, nbytes = timed(ipc_roundtrip, state())
+                totals.setdefault(mode, [0, 0.0])
+                totals[mode][0] += nbytes
+                totals[mode][1] += seconds
+                print(f'{os.path.basename(data_file):<32}{mode:>10}{nbytes:>14}{seconds:>10.4f}')
+            sample.spill_dir = spill_dir
+            seconds, nbytes = timed(ipc_roundtrip, sample)
+            totals.setdefault('spill', [0, 0.0])
+            totals['spill'][0] += nbytes
+            totals['spill'][1] += seconds
+            print(f'{os.path.basename(data_file):<32}{"spill":>10}{nbytes:>14}{seconds:>10.4f}')
+        for mode, (nbytes, seconds) in totals.items():
+            print(f'{"total":<32}{mode:>10}{nbytes:>14}{seconds:>10.4f}')
+
+        print('--- end to end parsing with a worker pool ---')
+        for mode, directory in [('pipe', None), ('spill', spill_dir)]:
+            seconds, samples = timed(pool_parse, var_samples, directory, repeat=1)
+            print(f'{mode:>10}: {seconds:.4f}s for {len(samples)} files')
+
+def legacy_duration_array(samples, sample_duration=kernels.sample_duration):
+    result = []
+    vals = []
+    if len(samples) == 0:
+        return np.array(result), vals
+    values = samples.val.tolist()
+    seqids = samples.seqid.tolist()
+    duration = sample_duration
+    for index in range(1, len(samples)):
+        if values[index - 1] == values[index]:
+            delta = (seqids[index] - seqids[index - 1])/1000
+            duration = duration + delta
+        else:
+            vals.append(values[index - 1])
+            result.append(duration)
+            duration = sample_duration
+    vals.append(values[-1])
+    result.append(duration)
+    return np.array(result), vals
+
+def legacy_value_array(samples):
+    return np.array(samples.val.tolist())
+
+def legacy_delta_array(values):
+    result = []
+    if values.size == 0:
+        return np.array(result)
+    prev_value = values[0]
+    for i, value in enumerate(values):
+        result.append(value - prev_value)
+        prev_value = value
+    return np.array(result)
+
+def synthetic_samples(count, mean_run, seed):
+    """unfolded samples of one variable: increasing timestamps in us and
+    values repeated over geometric runs, with a few very long runs
+    """
+    rng = np.random.default_rng(seed)
+    samples = np.zeros(count, dtype=SampleDtype).view(np.recarray)
+    samples.seqid = np.cumsum(rng.integers(1, 20000, count, dtype=np.uint64)) + np.uint64(1 << 40)
+    new_value = rng.random(count) < 1.0 / mean_run
+    new_value[rng.integers(0, count, 4)] = False
+    samples.val = np.cumsum(new_value * rng.integers(1, 1 << 20, count, dtype=np.uint64)).astype(np.uint64)
+    return samples
+
+def same_array(a, b):
+    return a.dtype == b.dtype and a.shape == b.shape and np.array_equal(a, b)
+
+def bench_kernels(args):
+    """vectorized duration/value/delta kernels against the sequential loops they replace
+    """
+    samples = synthetic_samples(int(args.n), float(args.run), int(args.seed))
+    print(f'{len(samples)} samples, mean run length {args.run}')
+    legacy_seconds, (legacy_durations, legacy_vals) = timed(legacy_duration_array, samples, repeat=1)
+    seconds, (durations, vals) = timed(kernels.duration_array, samples)
+    print(f'duration_array: {legacy_seconds:.4f}s -> {seconds:.4f}s ({legacy_seconds / seconds:.1f}x), '
+        f'identical={same_array(legacy_durations, durations) and legacy_vals == vals.tolist()}')
+    legacy_seconds, legacy_values = timed(legacy_value_array, samples, repeat=1)
+    seconds, values = timed(kernels.value_array, samples)
+    print(f'value_array:    {legacy_seconds:.4f}s -> {seconds:.4f}s ({legacy_seconds / seconds:.1f}x), '
+        f'identical={same_array(legacy_values, values)}')
+    legacy_seconds, legacy_deltas = timed(legacy_delta_array, legacy_values, repeat=1)
+    seconds, deltas = timed(kernels.delta_array, values)
+    print(f'delta_array:    {legacy_seconds:.4f}s -> {seconds:.4f}s ({legacy_seconds / seconds:.1f}x), '
+        f'identical={same_array(legacy_deltas, deltas)}')
+
+def legacy_range_outliers(norm, bug, threshold):
+    n_bug, c_bug = np.unique(bug, return_counts=True)
+    n_norm = np.unique(norm)
+    maxnorm = np.amax(n_norm)
+    minnorm = np.amin(n_norm)
+    bad_sample = 0
+    outliers = []
+    for i, val in enumerate(n_bug):
+        if val * threshold > maxnorm or val < minnorm * threshold:
+            bad_sample += c_bug[i]
+            outliers.append(val)
+    return float(bad_sample/bug.size), outliers
+
+def legacy_delta_outliers(bug_values, outlier_delta):
+    outlier = []
+    prev_val = bug_values[0]
+    for i, val in enumerate(bug_values):
+        if val - prev_val in outlier_delta:
+            outlier.append(val)
+        prev_val = val
+    return outlier
+
+def legacy_processing_outliers(bug_duration, duration_outliers, bug_vals):
+    outliers = []
+    for i, processing in enumerate(bug_duration):
+        if processing in duration_outliers:
+            outliers.append(bug_vals[i])
+    return outliers
+
+def bench_outliers(args):
+    """outlier detection and mapping of a bug variable drifting out of the norm range,
+    so that thousands of distinct values, deltas and durations are outliers
+    """
+    n = int(args.n)
+    #range_distance only reads the threshold, no samples are needed to build the calculator
+    calculator = kernels.VarDiscountCalculator.__new__(kernels.VarDiscountCalculator)
+    calculator.threshold = float(args.threshold)
+    norm_samples = synthetic_samples(n, float(args.run), int(args.seed))
+    bug_samples = synthetic_samples(n, float(args.run), int(args.seed) + 1)
+    #scale the bug values and timestamps out of the norm range
+    bug_samples.val = bug_samples.val * np.uint64(3)
+    bug_samples.seqid = bug_samples.seqid + (bug_samples.seqid - bug_samples.seqid[0]) * np.uint64(2)
+    norm_values = kernels.value_array(norm_samples)
+    bug_values = kernels.value_array(bug_samples)
+    norm_durations, _ = kernels.duration_array(norm_samples)
+    bug_durations, bug_vals = kernels.duration_array(bug_samples)
+    norm_deltas = kernels.delta_array(norm_values)
+    bug_deltas = kernels.delta_array(bug_values)
+    print(f'{n} samples per variable, threshold {calculator.threshold}')
+
+    legacy_seconds, (legacy_diff, legacy_outliers) = timed(legacy_range_outliers, norm_values, bug_values, calculator.threshold, repeat=1)
+    seconds, (diff, outliers) = timed(calculator.range_distance, norm_values, bug_values)
+    print(f'range_distance:     {len(outliers)} outliers, {legacy_seconds:.4f}s -> {seconds:.4f}s ({legacy_seconds / seconds:.1f}x), '
+        f'identical={legacy_diff == diff and legacy_outliers == outliers.tolist()}')
+
+    _, outlier_delta = calculator.range_distance(norm_deltas, bug_deltas)
+    legacy_seconds, legacy_outliers = timed(legacy_delta_outliers, bug_values, outlier_delta.tolist(), repeat=1)
+    seconds, outliers = timed(lambda: bug_values[np.isin(bug_deltas, outlier_delta)])
+    print(f'delta mapping:      {len(outlier_delta)} outliers, {legacy_seconds:.4f}s -> {seconds:.4f}s ({legacy_seconds / seconds:.1f}x), '
+        f'identical={legacy_outliers == outliers.tolist()}')
+
+    _, duration_outliers = calculator.range_distance(norm_durations, bug_durations)
+    legacy_seconds, legacy_outliers = timed(legacy_processing_outliers, bug_durations, duration_outliers.tolist(), bug_vals.tolist(), repeat=1)
+    seconds, outliers = timed(lambda: bug_vals[np.isin(bug_durations, duration_outliers)])
+    print(f'processing mapping: {len(duration_outliers)} outliers, {legacy_seconds:.4f}s -> {seconds:.4f}s ({legacy_seconds / seconds:.1f}x), '
+        f'identical={legacy_outliers == outliers.tolist()}')
+
+def legacy_hellinger_distance(norm, bug):
+    def distribute(samples):
+        values, counts = np.unique(samples, return_counts=True)
+        result = {}
+        for index in range(values.size):
+            result[values[index]] = float(counts[index]/samples.size)
+        return result
+
+    def align_array(dict1, dict2, values, default):
+        arr1 = []
+        arr2 = []
+        for val in values:
+            arr1.append(dict1.get(val, default))
+            arr2.append(dict2.get(val, default))
+        return np.array(arr1), np.array(arr2)
+
+    norm_dict = distribute(norm)
+    bug_dict = distribute(bug)
+    values = np.unique(np.concatenate([norm, bug]))
+    norm_dist, bug_dist = align_array(norm_dict, bug_dict, values, 0.0)
+    return kernels.euclidean(np.sqrt(norm_dist), np.sqrt(bug_dist)) / np.sqrt(2)
+
+def bench_hellinger(args):
+    """Hellinger distance over the distinct values, against the dict alignment it
+    replaces, and over fixed bins for durations
+    """
+    n = int(args.n)
+    calculator = kernels.VarDiscountCalculator.__new__(kernels.VarDiscountCalculator)
+    norm_samples = synthetic_samples(n, float(args.run), int(args.seed))
+    bug_samples = synthetic_samples(n, float(args.run), int(args.seed) + 1)
+    for name, norm, bug in [('values', kernels.value_array(norm_samples), kernels.value_array(bug_samples)),
+            ('durations', kernels.duration_array(norm_samples)[0], kernels.duration_array(bug_samples)[0])]:
+        domain = np.unique(np.concatenate([norm, bug])).size
+        legacy_seconds, legacy_distance = timed(legacy_hellinger_distance, norm, bug, repeat=1)
+        seconds, distance = timed(calculator.hellinger_distance, norm, bug)
+        print(f'{name:<10} {domain:>8} distinct: {legacy_seconds:.4f}s -> {seconds:.4f}s ({legacy_seconds / seconds:.1f}x), '
+            f'identical={legacy_distance == distance}')
+    seconds, distance = timed(calculator.hellinger_distance, norm, bug, int(args.bins))
+    print(f'durations {int(args.bins):>8} bins:     {seconds:.4f}s, distance {distance:.4f} (distinct values {legacy_distance:.4f})')
+
+class SyntheticHists:
+    """stands in for gmonSamples: count flat profiles ranking nsymbols functions,
+    each a shuffle of a common order within a few ranks
+    """
+    def __init__(self, count, nsymbols, rng):
+        Entry = namedtuple('Entry', ['symbol'])
+        Hist = namedtuple('Hist', ['entries'])
+        self.samples = []
+        for _ in range(count):
+            order = np.argsort(np.arange(nsymbols) + rng.normal(0, 3, nsymbols))
+            self.samples.append(Hist([Entry(f'func{i}') for i in order.tolist()]))
+        self.size = count
+
+    def get_samples(self):
+        return self.samples
+
+def legacy_rank_counts(calculator, bug_hist, norm_hist):
+    for index in range(len(bug_hist)):
+        func = bug_hist[index].symbol
+        lookahead = calculator.max_ahead
+        while lookahead >= -calculator.max_ahead:
+            try:
+                if norm_hist[index - lookahead].symbol == func:
+                    calculator.rank_counts[func] = calculator.rank_counts[func] + 1
+                    break
+            except:
+                pass
+            lookahead = lookahead - 1
+    return calculator.rank_counts
+
+def legacy_aggregate_rank_counts(calculator):
+    for bugsample in calculator.bug_samples.get_samples():
+        for normsample in calculator.norm_samples.get_samples():
+            legacy_rank_counts(calculator, bugsample.entries, normsample.entries)
+    return calculator.rank_counts
+
+def bench_ranks(args):
+    """rank counts of the cost discounts over all bug x norm histogram pairs
+    """
+    rng = np.random.default_rng(int(args.seed))
+    norms = SyntheticHists(int(args.captures), int(args.symbols), rng)
+    bugs = SyntheticHists(int(args.captures), int(args.symbols), rng)
+    print(f'{args.captures} x {args.captures} histograms of {args.symbols} symbols')
+    legacy_seconds, legacy_counts = timed(lambda: legacy_aggregate_rank_counts(CostDiscountCalculator(norms, bugs)), repeat=1)
+    seconds, counts = timed(lambda: CostDiscountCalculator(norms, bugs).count_ranks(
+        [sample.entries for sample in bugs.samples], [sample.entries for sample in norms.samples]))
+    print(f'rank counts: {legacy_seconds:.4f}s -> {seconds:.4f}s ({legacy_seconds / seconds:.1f}x), '
+        f'identical={list(legacy_counts.items()) == list(counts.items())}')
+
+class SyntheticGmon:
+    """stands in for gmonSample: a flat profile of a random subset of nsymbols functions
+    """
+    def __init__(self, nsymbols, rng):
+        self.hist_dict = {}
+        for i in np.flatnonzero(rng.random(nsymbols) < 0.9).tolist():
+            calls = int(rng.integers(1, 100000))
+            self_time = float(rng.random() * 10)
+            self.hist_dict[f'func{i}'] = histEntry([rng.random() * 100, self_time, self_time, calls,
+                self_time / calls, self_time / calls, f'func{i}'])
+
+    def get_hist_dict(self):
+        return self.hist_dict
+
+def legacy_aggregate(gmons):
+    key_count = {}
+    hist_dict = {}
+    for sample in gmons.samples:
+        local_hist = sample.get_hist_dict()
+        for key in local_hist:
+            if not key in hist_dict:
+                hist_dict[key] = local_hist[key]
+                key_count[key] = 1
+            else:
+                for attribute in gmons.attribute_list:
+                    old_val = hist_dict[key].get_attr(attribute)
+                    hist_dict[key].set_attr(attribute, old_val + local_hist[key].get_attr(attribute))
+                key_count[key] = key_count[key] + 1
+    for key in key_count:
+        if key_count[key] <= 1:
+            continue
+        for attribute in gmons.attribute_list:
+            hist_dict[key].set_attr(attribute, hist_dict[key].get_attr(attribute) / key_count[key])
+    return hist_dict
+
+def bench_aggregate(args):
+    """aggregation of the flat profiles of many gmon captures
+    """
+    rng = np.random.default_rng(int(args.seed))
+    gmons = gmonSamples.__new__(gmonSamples)
+    gmons.attribute_list = ['total_percentage', 'total_time', 'self_time', 'calls', 'total_per_call', 'self_per_call']
+    gmons.samples = [SyntheticGmon(int(args.symbols), rng) for _ in range(int(args.captures))]
+    print(f'{args.captures} captures of up to {args.symbols} symbols')
+    legacy_seconds, legacy = timed(lambda: legacy_aggregate(copy.deepcopy(gmons)), repeat=1)
+    seconds, aggregated = timed(gmons.aggregate)
+    identical = list(legacy) == list(aggregated) and all(getattr(legacy[key], attribute) == getattr(aggregated[key], attribute)
+        for key in legacy for attribute in gmons.attribute_list)
+    print(f'mean:       {legacy_seconds:.4f}s (with the copy the in place merge needs) -> {seconds:.4f}s, identical={identical}')
+    seconds, _ = timed(gmons.hist_statistics, (50, 90, 99))
+    print(f'statistics: {seconds:.4f}s for mean, median, 3 percentiles and variance')
+
+def synthetic_call_graph(nsymbols, narcs, seed):
+    """random arcs between nsymbols functions, with cycles, recursive calls and a
+    share of arcs of count 0 as the gprof fallback may list them
+    """
+    rng = np.random.default_rng(seed)
+    names = [f'func{i}' for i in range(nsymbols)]
+    parents = rng.integers(0, nsymbols, narcs)
+    children = rng.integers(0, nsymbols, narcs)
+    counts = rng.integers(0, 1000, narcs) * (rng.random(narcs) > 0.1)
+    return CallGraph([names[i] for i in parents.tolist()], [names[i] for i in children.tolist()], counts)
+
+def bench_callgraph(args):
+    """cost propagation over the call graph, and the graphs it must not divide by zero on
+    """
+    graph = synthetic_call_graph(int(args.symbols), int(args.arcs), int(args.seed))
+    self_cost = np.random.default_rng(int(args.seed)).random(graph.size())
+    print(f'{graph.size()} symbols, {graph.callees.size} arcs')
+    with np.errstate(all='raise'):
+        seconds, inclusive = timed(graph.propagate, self_cost)
+        print(f'propagate:     {seconds:.4f}s, finite={bool(np.isfinite(inclusive).all())}')
+        seconds, path = timed(graph.heaviest_path, inclusive, int(np.argmax(inclusive)))
+        print(f'heaviest_path: {seconds:.4f}s over {len(path)} functions')
+        #callees reached only over arcs of count 0, alone and in a cycle
+        for parents, children in [(['main'], ['f']), (['main', 'a', 'b', 'b'], ['a', 'b', 'a', 'leaf'])]:
+            graph = CallGraph(parents, children, [0] * len(parents))
+            inclusive = graph.propagate(np.ones(graph.size()))
+            path = graph.heaviest_path(inclusive, 0)
+            print(f'count 0 arcs {"->".join(graph.names)}: self cost kept={bool((inclusive == 1).all())}, path={path}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro benchmarks of the post profiling analysis')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ipc = subparsers.add_parser('ipc', help='size and time of returning parsed gmon_var files from workers')
+    ipc.add_argument('--dir', required=True, help='directory with gmon_var and layout files')
+    ipc.add_argument('--bin', required=True, help='profiled binary')
+    ipc.add_argument('--max', default=8, help='maximum number of files')
+    ipc.add_argument('--mmap', action='store_true', help='map gmon_var files instead of reading them into memory')
+    ipc.set_defaults(func=bench_ipc)
+
+    kernel = subparsers.add_parser('kernels', help='duration, value and delta extraction on synthetic samples')
+    kernel.add_argument('--n', default=1000000, help='number of samples')
+    kernel.add_argument('--run', default=4, help='mean length of a run of equal values')
+    kernel.add_argument('--seed', default=0)
+    kernel.set_defaults(func=bench_kernels)
+
+    outliers = subparsers.add_parser('outliers', help='outlier detection and mapping with thousands of distinct outliers')
+    outliers.add_argument('--n', default=50000, help='number of samples per variable')
+    outliers.add_argument('--run', default=4, help='mean length of a run of equal values')
+    outliers.add_argument('--seed', default=0)
+    outliers.add_argument('--threshold', default=0.95, help='range threshold of the discount calculator')
+    outliers.set_defaults(func=bench_outliers)
+
+    hellinger = subparsers.add_parser('hellinger', help='Hellinger distance over distinct values and fixed bins')
+    hellinger.add_argument('--n', default=200000, help='number of samples per variable')
+    hellinger.add_argument('--run', default=4, help='mean length of a run of equal values')
+    hellinger.add_argument('--seed', default=0)
+    hellinger.add_argument('--bins', default=64, help='bins of the fixed-bin mode')
+    hellinger.set_defaults(func=bench_hellinger)
+
+    ranks = subparsers.add_parser('ranks', help='rank counts of the cost discounts over all histogram pairs')
+    ranks.add_argument('--captures', default=20, help='number of norm and of bug histograms')
+    ranks.add_argument('--symbols', default=2000, help='number of symbols per histogram')
+    ranks.add_argument('--seed', default=0)
+    ranks.set_defaults(func=bench_ranks)
+
+    aggregate = subparsers.add_parser('aggregate', help='aggregation of the flat profiles of many gmon captures')
+    aggregate.add_argument('--captures', default=300, help='number of gmon captures')
+    aggregate.add_argument('--symbols', default=2000, help='number of symbols per capture')
+    aggregate.add_argument('--seed', default=0)
+    aggregate.set_defaults(func=bench_aggregate)
+
+    callgraph = subparsers.add_parser('callgraph', help='cost propagation over a call graph with cycles and arcs of count 0')
+    callgraph.add_argument('--symbols', default=20000, help='number of functions')
+    callgraph.add_argument('--arcs', default=100000, help='number of arcs')
+    callgraph.add_argument('--seed', default=0)
+    callgraph.set_defaults(func=bench_callgraph)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -8,19 +8,24 @@ import argparse
 import re
 from collections import namedtuple
 import operator
+import tempfile
+import contextlib
 import numpy as np
 
 from gmon_sample_multiprocessing import histEntry, gmonSamples
 from cost_discount_multiprocessing import CostDiscountCalculator
 from static_analyzer import key_desc, Layout
-from var_sample_multiprocessing import VarSamples
-from var_discount_multiprocessing import VarDiscountCalculator
-from multiprocessing import Pool
+from var_sample_multiprocessing import VarSamples, sampling_period
+from vprof_baseline import load_baseline
+from var_discount_multiprocessing import VarDiscountCalculator, VarSampleSummary, value_array
+from multiprocessing import Pool, cpu_count, get_context
 
 import time
 
 class DiscountAttributer:
-    def __init__(self, norm_vars, norm_gmon, bug_vars, bug_gmon, index, default_discount, valid_discount):
+    def __init__(self, norm_vars, norm_gmon, bug_vars, bug_gmon, index, default_discount, valid_discount, engine='thread', workers=None,
+            cost_discounts=None, stats='batched', max_samples=None, seed=0, duration_bins=None,
+            compare='random', aggregate='median', norm_cache=None, stats_cache=None, stats_cache_size=4096, threads=False):
         self.hist_attr_list=[ 'total_percentage',\
                 'total_time',\
                 'self_time',\
@@ -30,14 +35,35 @@ class DiscountAttributer:
         self.time_per_sample = 0.005 #seconds
         self.cost_calculator = CostDiscountCalculator(norm_gmon, bug_gmon)
         self.cost_calculator.set_valid_discount(valid_discount)
-        self.cost_discounts = self.cost_calculator.aggregate_discount()
+        #the cost discounts do not depend on the reported index, runs over several indexes share them
+        if cost_discounts is None:
+            cost_discounts = self.cost_calculator.aggregate_discount()
+        self.cost_discounts = cost_discounts
 
         self.var_calculator = VarDiscountCalculator(norm_vars, bug_vars, index)
         self.var_calculator.set_valid_discount(valid_discount)
         self.var_calculator.set_default_discount(default_discount)
+        self.var_calculator.set_engine(engine, workers)
+        self.var_calculator.set_stats(stats)
+        self.var_calculator.set_approximate(max_samples, seed)
+        self.var_calculator.set_duration_bins(duration_bins)
+        self.var_calculator.set_norm_comparison(compare, aggregate, norm_cache)
+        self.var_calculator.set_stats_cache(stats_cache_size, stats_cache)
         self.default_discount = default_discount
 
         self.bug_sample = self.var_calculator.aggregate_discount_for_varsample(bug_vars.samples[index])
+        #samples of the bug capture stand for the sampling period of its profiler
+        self.time_per_sample = sampling_period(getattr(self.bug_sample, 'prof_rate', 0)) or self.time_per_sample
+        self.check_sampling_rates('gmon_var', self.var_calculator.norms + [self.bug_sample])
+        self.check_sampling_rates('gmon', norm_gmon.samples + bug_gmon.samples[index:index + 1])
+
+        #thread class -> calculator of its discounts, compared to the same class of the norms
+        self.thread_calculators = {}
+        if threads:
+            for thread in range(self.bug_sample.threads().size):
+                calculator = self.var_calculator.thread_calculator(thread)
+                calculator.aggregate_discount_for_varsample(self.bug_sample.thread_view(thread))
+                self.thread_calculators[thread] = calculator
 
         self.discount_on_func = self.var_calculator.discount_on_func
         self.annotate_on_func = self.var_calculator.annotate_on_func
@@ -52,6 +78,19 @@ class DiscountAttributer:
                 self.func_to_descs[func].append(desc)
         unfold_descs()
 
+    def check_sampling_rates(self, kind, captures):
+        """warn when the captures compared were profiled at different rates; each one is
+        still converted to time with its own rate
+        """
+        rates = defaultdict(list)
+        for capture in captures:
+            rate = getattr(capture, 'prof_rate', 0)
+            if rate:
+                rates[rate].append(os.path.basename(getattr(capture, 'datafile', None) or getattr(capture, 'infile', '')))
+        if len(rates) > 1:
+            listed = '; '.join(f'{rate} Hz: {", ".join(files)}' for rate, files in sorted(rates.items()))
+            print(f'warning: {kind} captures sampled at different rates ({listed})')
+
     def sample_counts_for_funcs(self):
         """make up function cost due to execution outside text segment such as call to dynamic libraries
         """
@@ -132,27 +171,33 @@ class DiscountAttributer:
 
     def sort_variable_location(self, layout, hist_entry):
         def collect_vals(outliers):
-            outlier_vals = set()
-            for vals in outliers:
-                for val in vals:
-                    outlier_vals.add(val)
-            return outlier_vals
+            """distinct outlier values over all norms and how many times each occurs,
+            repeats within the outliers of one norm included; the outliers of a key are
+            arrays of the bug values, so they share one dtype
+            """
+            arrays = [vals for vals in outliers if len(vals) > 0]
+            if len(arrays) == 0:
+                return np.array([]), np.array([], dtype=np.int64)
+            return np.unique(np.concatenate(arrays), return_counts=True)
 
         def translate_val_to_location(key, values):
             samples_locs = defaultdict(list)
-            for sample in self.bug_sample.unfold_samples_for_desc(key):
-                if sample.val in values and sample.line != None:
-                    samples_locs[sample.val].append(sample.file + '_' + str(sample.line))
-                    if self.bug_sample.attach_value_flow(key, sample, layout):
-                        samples_locs[sampel.val].append(':propagated_from_' + '||'.join(list(sample.propagate)))
+            samples = self.bug_sample.unfold_samples_for_desc(key)
+            sample_vals = value_array(samples)
+            located = np.isin(sample_vals, values) & (samples.line != None)
+            for i in np.flatnonzero(located).tolist():
+                sample = samples[i]
+                val = sample_vals[i].item()
+                samples_locs[val].append(sample.file + '_' + str(sample.line))
+                if self.bug_sample.attach_value_flow(key, sample, layout):
+                    samples_locs[val].append(':propagated_from_' + '||'.join(list(sample.propagate)))
             return samples_locs
         
-        def collect_locs(outliers_on_key, locations_on_key):
+        def collect_locs(values, counts, locations_on_key):
             locs = defaultdict(lambda:0)
-            for vals in outliers_on_key:
-                for val_i in vals:
-                    for item in locations_on_key[val_i]:
-                        locs[item] += 1
+            for val_i, count in zip(values.tolist(), counts.tolist()):
+                for item in locations_on_key.get(val_i, ()):
+                    locs[item] += count
             return locs
 
         if hist_entry.symbol not in self.func_to_descs:
@@ -163,8 +208,9 @@ class DiscountAttributer:
             outliers_on_key = self.bug_sample.outliers_dict[key]
             #sort them based on the list of discounts on key
             sorted_on_discounts = sorted(list(zip(discounts_on_key, outliers_on_key, self.desc_to_dimension[key])), key=lambda i: i[0])
-            locations_on_key = translate_val_to_location(key, collect_vals(outliers_on_key))
-            locs = collect_locs(outliers_on_key, locations_on_key)
+            outlier_vals, outlier_counts = collect_vals(outliers_on_key)
+            locations_on_key = translate_val_to_location(key, outlier_vals)
+            locs = collect_locs(outlier_vals, outlier_counts, locations_on_key)
             #display annotated info
             try:
                 print(f"\n\t\t{key}\n\t\t**Discount:{list(zip(*sorted_on_discounts))[0]}\n\t\t**dimension:[{', '.join(list(zip(*sorted_on_discounts))[2])}]")
@@ -172,10 +218,80 @@ class DiscountAttributer:
                 print(f'\n\t\tex: key = {key}, dim = {self.desc_to_dimension[key]}')
             pattern = self.infer_pattern(key.split()[-1], ''.join(self.desc_to_dimension[key]), max(discounts_on_key))
             print(f'\t\t**Pattern inferred: {pattern}')
+            if key in self.var_calculator.subsample_notes:
+                print(f'\t\t**Subsampled: {self.var_calculator.subsample_notes[key]}')
             if len(locs) > 0:
                 print(f'\t\t**Code area: {set(locs.keys())}')
 
-    def attribute_sample_cost(self, sample, layout, outfile):
+    def inclusive_cost(self, sample, hist_list):
+        """adjusted cost of every function plus the share of the adjusted cost of its
+        callees, propagated up the call graph of the gmon sample
+        """
+        graph = sample.call_graph
+        self_cost = np.zeros(graph.size())
+        for entry in hist_list:
+            if entry.symbol in graph.ids:
+                self_cost[graph.ids[entry.symbol]] += entry.cost
+        return graph, graph.propagate(self_cost)
+
+    def print_inclusive_cost(self, sample, hist_list, count):
+        print('--- Inclusive adjusted cost over the call graph ---')
+        graph, inclusive = self.inclusive_cost(sample, hist_list)
+        entries = {entry.symbol: entry for entry in hist_list}
+        costs = {entry.symbol: entry.cost for entry in hist_list}
+        for name, cost in zip(graph.names, inclusive.tolist()):
+            costs[name] = cost
+        print('{:<48}\t{}\t{}\t{}'.format('Function', 'inclusive_cost', 'adjusted_cost', 'discount'))
+        ranked = sorted(costs.items(), key=lambda item: item[1], reverse=True)
+        for i, (name, cost) in enumerate(ranked[:count]):
+            entry = entries.get(name)
+            print('[{}] {:<48}\t{:.2f}\t{:.2f}\t{:.2f}'.format(i, name, cost, entry.cost if entry else 0.0, entry.discount if entry else 0.0))
+        roots = [name for name, cost in ranked if name in graph.ids]
+        if len(roots) > 0:
+            path = graph.heaviest_path(inclusive, graph.ids[roots[0]])
+            print(f'**Heaviest path: {" -> ".join(graph.names[node] for node in path)}')
+
+    def thread_cost(self, hist_list):
+        """adjusted cost of every thread class: each function's cost split by the share of
+        its variable samples taken in the thread, discounted by the thread's own
+        discounts. Functions without variable samples cannot be split.
+        """
+        tids = self.bug_sample.threads()
+        thread_samples = np.zeros(tids.size, dtype=np.int64)
+        costs = np.zeros(tids.size)
+        top = [(0.0, None)] * tids.size
+        for entry in hist_list:
+            descs = self.func_to_descs.get(entry.symbol)
+            if not entry.symbol or not descs:
+                continue
+            #samples of the function per thread, its busiest variable as in sample_counts_for_funcs
+            counts = np.max([self.bug_sample.thread_counts(desc) for desc in descs], axis=0)
+            if counts.sum() == 0:
+                continue
+            thread_samples += counts
+            shares = float(getattr(entry, self.hist_attr_list[2])) * counts / counts.sum()
+            for thread, calculator in self.thread_calculators.items():
+                discount = calculator.discount_on_func.get(entry.symbol, self.cost_discounts.get(entry.symbol, 0.0))
+                cost = float(shares[thread]) * (1 - discount)
+                costs[thread] += cost
+                if cost > top[thread][0]:
+                    top[thread] = (cost, entry.symbol)
+        return tids, thread_samples, costs, top
+
+    def print_thread_cost(self, hist_list):
+        print('--- Adjusted cost per thread ---')
+        tids, thread_samples, costs, top = self.thread_cost(hist_list)
+        total = costs.sum()
+        print('{:<8}\t{}\t{}\t{}\t{}'.format('tid', 'samples', 'adjusted_cost', 'percentage', 'top function'))
+        for thread in np.argsort(-costs, kind='stable').tolist():
+            calculator = self.thread_calculators[thread]
+            cost, func = top[thread]
+            print('[{}] {:<8}\t{}\t{:.2f}\t{:.2f}\t{}'.format(thread, int(tids[thread]), int(thread_samples[thread]),
+                costs[thread], 100 * costs[thread] / total if total > 0 else 0.0, func or ''))
+            if func in calculator.annotate_on_func:
+                print(f'\t\t**Annotate variable: {calculator.annotate_on_func[func]}, discount {calculator.discount_on_func[func]:.2f}')
+
+    def attribute_sample_cost(self, sample, layout, outfile, inclusive=0):
         print('--- Update cost based on value samples ---')
         hist_list = self.update_cost(sample, self.hist_attr_list[2])
         print('--- Discounted cost based on {} ---'.format(self.hist_attr_list[2]))
@@ -184,46 +300,128 @@ class DiscountAttributer:
         for i, item in enumerate(hist_list):
             item.print_entry_with_index(i)
             self.sort_variable_location(layout, item)
+        if inclusive:
+            self.print_inclusive_cost(sample, hist_list, inclusive)
+        if self.thread_calculators:
+            self.print_thread_cost(hist_list)
 
 def vprof(args):
     start_time = time.time()
-    norm_gmons = gmonSamples(args.norms, args.norm_bin, int(args.max))
+    if args.baseline:
+        #norm captures reduced ahead of time by vprof_baseline.py
+        norm_vars = load_baseline(args.baseline, args.norm_bin)
+        norm_gmons = norm_vars.gmons
+    else:
+        norm_gmons = gmonSamples(args.norms, args.norm_bin, int(args.max))
+        norm_vars = VarSamples(args.norms, args.norm_bin, int(args.max), args.norm_srcinfo, args.mmap)
     bug_gmons = gmonSamples(args.bugs, args.bug_bin, int(args.max))
-    norm_vars = VarSamples(args.norms, args.norm_bin, int(args.max), args.norm_srcinfo)
-    bug_vars = VarSamples(args.bugs, args.bug_bin, int(args.max), args.bug_srcinfo)
-    with Pool() as pool:
-        norm_results = pool.map_async(norm_vars.parse_var_file, norm_vars.files_analyze)
-        bug_results = pool.map_async(bug_vars.parse_var_file, bug_vars.files_analyze)
-        pool.close()
-        pool.join()
-        norm_vars.samples = norm_results.get()
-        bug_vars.samples = bug_results.get()
+    bug_vars = VarSamples(args.bugs, args.bug_bin, int(args.max), args.bug_srcinfo, args.mmap)
+    indexes = parse_indexes(args.index, len(bug_vars.files_analyze), int(args.max))
+    if args.stream:
+        #only the reported bug samples are kept whole, the other files come back as summaries
+        bug_vars.set_reducer(VarSampleSummary, [bug_vars.files_analyze[index] for index in indexes if index < len(bug_vars.files_analyze)])
+        if not args.baseline:
+            norm_vars.set_reducer(VarSampleSummary)
+    #decode the binaries before forking so that workers share the address lookups
+    if not args.baseline:
+        norm_vars.load_layout()
+    bug_vars.load_layout()
+    #workers spill large sample arrays to shared memory instead of the result pipe
+    spill_context = tempfile.TemporaryDirectory(prefix='vprof-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None) \
+            if args.spill else contextlib.nullcontext()
+    with spill_context as spill_dir:
+        if args.spill:
+            norm_vars.spill_dir = spill_dir
+            bug_vars.spill_dir = spill_dir
+        with Pool() as pool:
+            if not args.baseline:
+                norm_results = pool.map_async(norm_vars.load_var_file, norm_vars.files_analyze)
+            bug_results = pool.map_async(bug_vars.load_var_file, bug_vars.files_analyze)
+            pool.close()
+            pool.join()
+            if not args.baseline:
+                norm_vars.samples = norm_results.get()
+            bug_vars.samples = bug_results.get()
 
     if norm_vars.size == 0 or bug_vars.size == 0:
         print('var samples missing in bug or norm case')
         exit(1)
     print("--- %s seconds parsing samples ---" % (time.time() - start_time))
 
-    for sample in norm_vars.samples:
-        sample.display_samples("var_samples.norms.txt")
+    if not args.baseline:
+        for sample in norm_vars.samples:
+            sample.display_samples("var_samples.norms.txt")
 
     for sample in bug_vars.samples:
         sample.display_samples("var_samples.bugs.txt")
 
-    print('--- Begin construct discount attributer ---')
-    start_time = time.time()
-    index = min(int(args.index), int(args.max) - 1)
     bug_vars.set_schemas()
     norm_vars.set_schemas()
+    if not multiple_indexes(args.index):
+        report_index(args, norm_vars, norm_gmons, bug_vars, bug_gmons, indexes[0])
+        return
+
+    #parse once, then report every index from a forked worker into its own file
+    global report_context
+    cost_calculator = CostDiscountCalculator(norm_gmons, bug_gmons)
+    cost_calculator.set_valid_discount(float(args.valid_discount))
+    report_context = (args, norm_vars, norm_gmons, bug_vars, bug_gmons, cost_calculator.aggregate_discount())
+    if args.engine == 'process':
+        #pool workers cannot start the descriptor pool of the process engine, report the indexes in turn
+        for index in indexes:
+            report_index_to_file(index)
+    else:
+        with get_context('fork').Pool(min(len(indexes), cpu_count())) as pool:
+            pool.map(report_index_to_file, indexes)
 
-    attributer = DiscountAttributer(norm_vars, norm_gmons, bug_vars, bug_gmons, index, float(args.default_discount), float(args.valid_discount))
+def report_index(args, norm_vars, norm_gmons, bug_vars, bug_gmons, index, cost_discounts=None):
+    print('--- Begin construct discount attributer ---')
+    start_time = time.time()
+    attributer = DiscountAttributer(norm_vars, norm_gmons, bug_vars, bug_gmons, index, float(args.default_discount), float(args.valid_discount),
+            args.engine, int(args.workers) if args.workers else None, cost_discounts, args.stats,
+            int(args.max_samples) if args.max_samples else None, int(args.seed),
+            int(args.duration_bins) if args.duration_bins else None,
+            compare=args.compare, aggregate=args.aggregate, norm_cache=args.norm_cache,
+            stats_cache=args.stats_cache, stats_cache_size=int(args.stats_cache_size), threads=args.threads)
     layout = Layout(bug_vars.samples[index].layout_file, args.bug_bin)
-    attributer.attribute_sample_cost(bug_gmons.samples[index], layout, args.output)
+    attributer.attribute_sample_cost(bug_gmons.samples[index], layout, args.output, int(args.inclusive) if args.inclusive else 0)
     print("--- %s seconds attribute sample cost ---" % (time.time() - start_time))
 
+#parsed samples and cost discounts of a multi-index run, inherited by the forked workers
+report_context = None
+
+def report_index_to_file(index):
+    args, norm_vars, norm_gmons, bug_vars, bug_gmons, cost_discounts = report_context
+    outfile = index_output(args.output, index)
+    with open(outfile, 'w') as f, contextlib.redirect_stdout(f):
+        report_index(args, norm_vars, norm_gmons, bug_vars, bug_gmons, index, cost_discounts)
+    print(f'--- report of bug sample {index} written to {outfile} ---')
+
+def multiple_indexes(index):
+    return str(index) == 'all' or ',' in str(index)
+
+def parse_indexes(index, nfiles, max_count):
+    """--index is a bug sample index, a comma separated list of them, or 'all'
+    """
+    if str(index) == 'all':
+        return list(range(min(nfiles, max_count)))
+    indexes = []
+    for item in str(index).split(','):
+        item = min(int(item), max_count - 1)
+        if item not in indexes:
+            indexes.append(item)
+    return indexes
+
+def index_output(output, index):
+    """report file of a bug sample: output with {index} substituted, or output.index
+    """
+    if '{index}' in output:
+        return output.replace('{index}', str(index))
+    return f'{output}.{index}'
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Attribute variable samples to corresponding functions')
-    parser.add_argument('--norm_bin', required=True, help='')
+    parser.add_argument('--norm_bin', help='')
     parser.add_argument('--bug_bin', required=True, help='')
     parser.add_argument('--norms', default = 'norms', help='')
     parser.add_argument('--bugs', default = 'bugs', help='')
@@ -232,10 +430,32 @@ if __name__ == '__main__':
 
     #default paramters
     parser.add_argument('--max', default = 8, help ='maximum number of samples supported to process')
-    parser.add_argument('--index', default = 0, help ='report based on the bug gmon in the bugid th bug sample')
-    parser.add_argument('--output', default = "vprof_discount_attribute.report")
+    parser.add_argument('--index', default = 0, help ='report based on the bug gmon in the bugid th bug sample; '
+            'a comma separated list or all writes one report per index to --output')
+    parser.add_argument('--inclusive', help='also list this many functions by adjusted cost including their callees, and the heaviest call path')
+    parser.add_argument('--threads', action='store_true', help='also compute the discounts of every thread of the bug capture, matched to the '
+            'norm threads by order of their first sample, and report the adjusted cost per thread')
+    parser.add_argument('--output', default = "vprof_discount_attribute.report", help='report file of a multi-index run, '
+            '{index} is replaced by the bug sample index, otherwise the index is appended')
     parser.add_argument('--default_discount', default = 0.8)
     parser.add_argument('--valid_discount', default = 0.1)
+    parser.add_argument('--mmap', action='store_true', help='map gmon_var files instead of reading them into memory')
+    parser.add_argument('--engine', default='thread', choices=['thread', 'process'], help='run the per-variable discounts on threads or forked processes')
+    parser.add_argument('--stats', default='batched', choices=['batched', 'scipy'], help='run the Anderson-Darling tests of all variables in one batch, or one scipy call each')
+    parser.add_argument('--compare', default='random', choices=['random', 'all'], help='compare the bug capture to one norm capture drawn at random, or to all of them')
+    parser.add_argument('--aggregate', default='median', choices=['median', 'pooled'], help='aggregate the discounts over the norm captures by their median, or their mean weighted by the norm sample counts')
+    parser.add_argument('--norm_cache', help='directory keeping the comparisons to every norm capture, so later runs only compare new captures')
+    parser.add_argument('--stats_cache', help='directory keeping the test results, Hellinger distances and range outliers by content hash of their inputs')
+    parser.add_argument('--stats_cache_size', default=4096, help='number of statistics results kept in memory')
+    parser.add_argument('--duration_bins', help='compare processing durations over this many equal-width bins in the Hellinger distance')
+    parser.add_argument('--max_samples', help='approximate mode: subsample every compared array of a variable to at most this many samples')
+    parser.add_argument('--seed', default=0, help='seed of the subsampling of --max_samples')
+    parser.add_argument('--workers', help='number of processes of the process engine, all cores by default')
+    parser.add_argument('--spill', action='store_true', help='return large sample arrays from workers through temporary .npy files')
+    parser.add_argument('--stream', action='store_true', help='reduce the norm and unreported bug files to per-variable summaries in the workers')
+    parser.add_argument('--baseline', help='norm baseline built by vprof_baseline.py, used instead of parsing --norms')
     args = parser.parse_args()
+    if not args.norm_bin and not args.baseline:
+        parser.error('--norm_bin is required unless a --baseline is given')
     print(f'default_ratio={args.default_discount}, valid_ratio={args.valid_discount}')
     vprof(args)